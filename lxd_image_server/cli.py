@@ -1,6 +1,6 @@
 import os
 import sys
-import re
+import time
 import traceback
 import logging
 import queue
@@ -9,19 +9,30 @@ import threading
 from logging.config import dictConfig
 from pathlib import Path
 import click
-import inotify.adapters
 import pidfile
 from inotify.constants import (IN_ATTRIB, IN_DELETE, IN_MOVED_FROM,
                                IN_MOVED_TO, IN_CLOSE_WRITE)
 from lxd_image_server.simplestreams.images import Images
+from lxd_image_server.tools import metrics
 from lxd_image_server.tools.cert import generate_cert
+from lxd_image_server.tools.checksum import ChecksumCache
+from lxd_image_server.tools.compress import Compressor
+from lxd_image_server.tools.daemon import WatchDaemon
 from lxd_image_server.tools.operation import Operations
+from lxd_image_server.tools.paths import is_version
+from lxd_image_server.tools.profiling import Profiler, batch, span
+from lxd_image_server.tools.reconcile import reconcile_operations
+from lxd_image_server.tools.tree import ImageTree
+from lxd_image_server.tools.upload import Uploads, start_upload_server
+from lxd_image_server.tools.watcher import Watcher
+from lxd_image_server.tools.batcher import OperationsBatcher
 from lxd_image_server.tools.mirror import MirrorManager
 from lxd_image_server.tools.config import Config
 
 
 logger = logging.getLogger(__name__)
 event_queue = queue.Queue()
+profiler = Profiler()
 
 
 def threaded(fn):
@@ -39,10 +50,34 @@ def configure_log(verbose=False):
     dictConfig(log_config)
 
 
+def checksum_cache():
+    return ChecksumCache(Config.get('checksum_cache'))
+
+
+def compressor():
+    compression = Config.get('compression', {})
+    return Compressor(
+        compression.get('formats', []),
+        {fmt: compression[fmt + '_level'] for fmt in ('gz', 'br', 'zst')
+         if fmt + '_level' in compression})
+
+
+def shard():
+    return Config.get('streams', {}).get('shard') or None
+
+
+def hashing_options(jobs=None):
+    hashing = Config.get('hashing', {})
+    return {
+        'jobs': jobs or hashing.get('jobs', 1),
+        'executor': hashing.get('executor', 'thread')
+    }
+
+
 def needs_update(events):
     modified_files = []
     for event in list(events):
-        if re.match('\d{8}_\d{2}:\d{2}', event[3]) or \
+        if is_version(event[3]) or \
             any(k in event[1]
                 for k in ('IN_MOVED_FROM', 'IN_MOVED_TO',
                           'IN_DELETE', 'IN_CLOSE_WRITE')):
@@ -53,30 +88,117 @@ def needs_update(events):
     return modified_files
 
 
+def load_config():
+    Config.load_data()
+    configure_log()
+
+
 def update_config():
     def reload_on_signal(signum, frame):
         logger.info('Relading configuration')
-        Config.load_data()
-        configure_log()
+        load_config()
         MirrorManager.update_mirror_list()
+
+    def toggle_profiling(signum, frame):
+        # Toggling waits for the running batch, so it is not done in the
+        # signal handler
+        threading.Thread(target=profiler.toggle, args=(profiling_dir(),),
+                         daemon=True).start()
     signal.signal(signal.SIGHUP, reload_on_signal)
+    signal.signal(signal.SIGUSR1, toggle_profiling)
+
+
+def profiling_dir():
+    return Config.get('profiling', {}).get(
+        'dump_dir', '/var/lib/lxd-image-server/profiles')
+
+
+def start_metrics():
+    """Expose the metrics if [metrics] in the configuration asks for it"""
+    config = Config.get('metrics', {})
+    metrics.QUEUE_DEPTH.set_function(event_queue.qsize)
+    metrics.MIRROR_LAG.set_function(lambda: {
+        (name,): stats['lag']
+        for name, stats in MirrorManager.stats().items()})
+    if config.get('listen'):
+        address, _, port = str(config['listen']).rpartition(':')
+        metrics.start_http_server(address or '127.0.0.1', int(port))
+    if config.get('textfile'):
+        metrics.start_textfile_writer(config['textfile'],
+                                      config.get('textfile_interval', 15))
+
+
+def start_uploads(img_dir, cache):
+    """Receive uploads if [upload] in the configuration asks for it
+
+    The checksums of the uploaded files go to the cache of the service,
+    so they are not hashed again when published.
+    """
+    config = Config.get('upload', {})
+    if not config.get('listen'):
+        return None
+    uploads = Uploads(img_dir, cache, config.get('staging_dir'))
+    return start_upload_server(str(config['listen']), uploads)
+
+
+def index_tree(root):
+    start = time.monotonic()
+    tree = ImageTree(root)
+    tree.scan()
+    logger.info('%d versions indexed in %.1fs', len(tree.versions),
+                time.monotonic() - start)
+    return tree
 
 
 @threaded
-def update_metadata(img_dir, streams_dir):
+def update_metadata(img_dir, streams_dir, cache):
     logger.info('start watching for new images')
     MirrorManager.img_dir = img_dir
+    MirrorManager.streams_dir = streams_dir
+    # The catalogue is loaded once and kept in memory between batches
+    images = Images(str(Path(streams_dir).resolve()), cache=cache,
+                    compressor=compressor(), shard=shard(),
+                    **hashing_options())
+    root = str(Path(img_dir).resolve())
+    tree = index_tree(root)
+    # Changes done while the service was stopped
+    with batch('reconcile') as timings:
+        with span('reconcile'):
+            ops = reconcile_operations(images, tree)
+        if ops:
+            with span('update'):
+                images.update(ops.ops)
+            with span('save'):
+                images.save()
+        timings.fields['operations'] = len(ops)
     MirrorManager.update_mirror_list()
+
+    watch_config = Config.get('watch', {})
+    batcher = OperationsBatcher(
+        event_queue, root,
+        watch_config.get('quiet_period', 2),
+        watch_config.get('max_latency', 30), tree)
     while True:
+        # Idle until the first events, which the batch does not account
         events = event_queue.get()
-        ops = Operations(events, str(Path(img_dir).resolve()))
-        if ops:
+        with batch('watch') as timings:
+            ops = batcher.next(events)
+            if not ops:
+                timings.discard()
+                continue
+            start = time.monotonic()
             logger.info('Updating server: %s', ','.join(
                 str(x) for x in ops.ops))
-            images = Images(str(Path(streams_dir).resolve()))
-            images.update(ops.ops)
-            images.save()
-            MirrorManager.update()
+            with profiler.profile():
+                with span('update'):
+                    images.update(ops.ops)
+                with span('save'):
+                    images.save()
+                with span('mirrors'):
+                    MirrorManager.update(ops.ops)
+            metrics.BATCH_OPERATIONS.observe(len(ops))
+            metrics.BATCH_SECONDS.observe(time.monotonic() - start)
+            timings.fields['operations'] = len(ops)
             logger.info('Server updated')
 
 
@@ -107,34 +229,94 @@ def cli(verbose):
               show_default=True,
               type=click.Path(exists=True, file_okay=False,
                               resolve_path=True))
+@click.option('--jobs', type=click.IntRange(min=1), default=None,
+              help='Number of workers hashing images [default: hashing.jobs '
+                   'from the configuration]')
 @click.pass_context
-def update(ctx, img_dir, streams_dir):
+def update(ctx, img_dir, streams_dir, jobs=None):
     logger.info('Updating server')
 
-    images = Images(str(Path(streams_dir).resolve()), rebuild=True)
+    images = Images(str(Path(streams_dir).resolve()), rebuild=True,
+                    cache=checksum_cache(), compressor=compressor(),
+                    shard=shard(), **hashing_options(jobs))
 
     # Generate a fake event to update all tree
     fake_events = [
         (None, ['IN_ISDIR', 'IN_CREATE'],
             str(img_dir.parent), str(img_dir.name))
     ]
-    operations = Operations(fake_events, str(img_dir))
-    images.update(operations.ops)
-    images.save()
+    with batch('update') as timings:
+        with span('operations'):
+            operations = Operations(fake_events, str(img_dir))
+        with span('update'):
+            images.update(operations.ops)
+        with span('evict'):
+            images.cache.evict()
+        with span('save'):
+            images.save()
+        with span('compress'):
+            images.compressor.join()
+        timings.fields['operations'] = len(operations)
 
     logger.info('Server updated')
 
 
-@cli.command('reload', help='Reload daemon configuration')
-def reload_config():
+@cli.command(help='Update only the versions that changed since the last '
+                  'update')
+@click.option('--img_dir', default='/var/www/simplestreams/images',
+              show_default=True,
+              type=click.Path(exists=True, file_okay=False,
+                              resolve_path=True))
+@click.option('--streams_dir', default='/var/www/simplestreams/streams/v1',
+              show_default=True,
+              type=click.Path(exists=True, file_okay=False,
+                              resolve_path=True))
+@click.option('--jobs', type=click.IntRange(min=1), default=None,
+              help='Number of workers hashing images [default: hashing.jobs '
+                   'from the configuration]')
+def reconcile(img_dir, streams_dir, jobs=None):
+    logger.info('Reconciling server')
+
+    images = Images(str(Path(streams_dir).resolve()),
+                    cache=checksum_cache(), compressor=compressor(),
+                    shard=shard(), **hashing_options(jobs))
+    operations = reconcile_operations(
+        images, index_tree(str(Path(img_dir).resolve())))
+    if operations:
+        logger.info('Updating server: %s', ','.join(
+            str(x) for x in operations.ops))
+        images.update(operations.ops)
+        images.save()
+        images.compressor.join()
+    else:
+        # Entries evicted by the reconcile
+        images.cache.save()
+
+    logger.info('Server reconciled')
+
+
+def _signal_daemon(signum, action):
     pidfile = Config.pidfile
     if pidfile and pidfile.exists():
         with open(pidfile, 'r') as fread:
             pid = int(fread.read())
-            logger.warning('Sending SIGHUP to %s for reloading', pid)
-            os.kill(pid, signal.SIGHUP)
+            logger.warning('Sending %s to %s for %s', signum.name, pid,
+                           action)
+            os.kill(pid, signum)
         return
-    logger.warning('pidfile %s does not exist maybe the daemon is not running')
+    logger.warning('pidfile %s does not exist maybe the daemon is not '
+                   'running', pidfile)
+
+
+@cli.command('reload', help='Reload daemon configuration')
+def reload_config():
+    _signal_daemon(signal.SIGHUP, 'reloading')
+
+
+@cli.command('profile', help='Start or stop profiling the daemon, the '
+                             'stats are written to profiling.dump_dir')
+def profile():
+    _signal_daemon(signal.SIGUSR1, 'profiling')
 
 
 @cli.command()
@@ -187,22 +369,62 @@ def watch(ctx, img_dir, streams_dir):
         _watch(img_dir, streams_dir)
 
 def _watch(img_dir, streams_dir):
+    if Config.get('watch', {}).get('daemon', 'asyncio') != 'thread':
+        _watch_daemon(img_dir, streams_dir)
+        return
+
     # Lauch threads
     update_config()
-    update_metadata(img_dir, streams_dir)
+    start_metrics()
+    cache = checksum_cache()
+    start_uploads(img_dir, cache)
+    update_metadata(img_dir, streams_dir, cache)
 
-    i = inotify.adapters.InotifyTree(str(Path(img_dir).resolve()),
-                                     mask=(IN_ATTRIB | IN_DELETE |
-                                           IN_MOVED_FROM | IN_MOVED_TO |
-                                           IN_CLOSE_WRITE))
+    watcher = Watcher(str(Path(img_dir).resolve()),
+                      mask=(IN_ATTRIB | IN_DELETE | IN_MOVED_FROM |
+                            IN_MOVED_TO | IN_CLOSE_WRITE),
+                      poll_interval=Config.get('watch', {}).get(
+                          'poll_interval', 60))
 
-    while True:
-        events = i.event_gen(yield_nones=False, timeout_s=15)
+    metrics.WATCHES.set_function(lambda: watcher.watch_count)
+
+    for events in watcher.batches(timeout_s=15):
         files_changed = needs_update(events)
+        metrics.EVENTS.inc(len(events))
+        metrics.EVENTS_FILTERED.inc(len(events) - len(files_changed))
         if files_changed:
             event_queue.put(files_changed)
 
 
+def _watch_daemon(img_dir, streams_dir):
+    update_config()
+    MirrorManager.img_dir = img_dir
+    MirrorManager.streams_dir = streams_dir
+    start_metrics()
+
+    watch_config = Config.get('watch', {})
+    images = Images(str(Path(streams_dir).resolve()), cache=checksum_cache(),
+                    compressor=compressor(), shard=shard(),
+                    **hashing_options())
+    start_uploads(img_dir, images.cache)
+    root = str(Path(img_dir).resolve())
+    watcher = Watcher(root,
+                      mask=(IN_ATTRIB | IN_DELETE | IN_MOVED_FROM |
+                            IN_MOVED_TO | IN_CLOSE_WRITE),
+                      poll_interval=watch_config.get('poll_interval', 60))
+    metrics.WATCHES.set_function(lambda: watcher.watch_count)
+
+    daemon = WatchDaemon(
+        watcher, images, index_tree(root), needs_update,
+        quiet_period=watch_config.get('quiet_period', 0.25),
+        max_latency=watch_config.get('max_latency', 1),
+        max_pending=watch_config.get('max_pending', 10000),
+        mirror_concurrency=Config.get('mirror_concurrency', 4),
+        drain_timeout=watch_config.get('drain_timeout', 300),
+        profiler=profiler, reload=load_config)
+    daemon.run()
+
+
 def main():
     try:
         sys.exit(cli())
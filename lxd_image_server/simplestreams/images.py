@@ -1,126 +1,371 @@
-import hashlib
-import json
 import time
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 import attr
+from lxd_image_server.tools import metrics
 from lxd_image_server.tools.operation import OperationType
-from lxd_image_server.simplestreams.index import Index
+from lxd_image_server.tools.profiling import span
+from lxd_image_server.tools.checksum import (ChecksumCache, sha256_files,
+                                             stat_signature)
+from lxd_image_server.tools.publish import Publication, file_digest
+from lxd_image_server.simplestreams.index import Index, products_file
+from lxd_image_server.simplestreams.model import (Item, Product, Products,
+                                                  Version)
+from lxd_image_server.simplestreams.serializer import dumps, load
 
 
-@attr.s
-class Version(object):
-    name = attr.ib()
-    path = attr.ib()
-    root_path = attr.ib()
+# Ways of splitting the products in several files
+SHARDS = (None, 'os', 'os/arch')
+
+
+def _get_type(name):
+    if 'squashfs' in name:
+        return 'squashfs'
+    elif 'vcdiff' in name:
+        return 'squashfs.vcdiff'
+    return name
+
+
+def _combined_checksum(path, files, signatures, cache):
+    """Checksum of lxd.tar.xz followed by the rootfs squashfs
+
+    Both files are read once to get their own checksums and the
+    combined one, which is cached for the pair of files.
+    """
+    squashfs = [f for f in files if _get_type(f) == 'squashfs']
+    if 'lxd.tar.xz' not in files or not squashfs:
+        return {}, None
+    pair = ['lxd.tar.xz',
+            'rootfs.squashfs' if 'rootfs.squashfs' in squashfs
+            else squashfs[0]]
+    pair_signatures = [signatures[f] for f in pair]
+
+    combined = cache.lookup(path, pair_signatures)
+    if combined is not None:
+        return {}, combined
+
+    digests, combined = sha256_files([str(Path(path, f)) for f in pair])
+    for f, digest in zip(pair, digests):
+        cache.store(str(Path(path, f)), signatures[f], digest)
+    cache.store(path, pair_signatures, combined)
+    return dict(zip(pair, digests)), combined
 
-    def __attrs_post_init__(self):
-        self.root = {
-            self.name: {
-                'items': {}
-            }
-        }
-        self.combined_sha = hashlib.new('sha256')
-
-        for f in [str(x.name) for x in Path(self.path).iterdir()
-                  if Path(self.path, x).is_file()]:
-            self.root[self.name]['items'].update({
-                f: {
-                    'sha256':
-                        self._sha256_checksum(str(Path(self.path, f))),
-                    'size': Path(self.path, f).stat().st_size,
-                    'path':
-                        str('images' /
-                            Path(self.path).relative_to(self.root_path) / f),
-                    'ftype': self._get_type(f)
-                }
-            })
-
-        if len(self.root[self.name]['items']) > 1 and \
-                self.root[self.name]['items'].get('lxd.tar.xz'):
-            self.root[self.name]['items']['lxd.tar.xz'] \
-                ['combined_squashfs_sha256'] = self.combined_sha.hexdigest()
-
-    def _get_type(self, name):
-        if 'squashfs' in name:
-            return 'squashfs'
-        elif 'vcdiff' in name:
-            return 'squashfs.vcdiff'
-        return name
-
-    def _sha256_checksum(self, filename, block_size=65536):
-        sha256 = hashlib.sha256()
-        with open(filename, 'rb') as f:
-            for block in iter(lambda: f.read(block_size), b''):
-                sha256.update(block)
-                self.combined_sha.update(block)
-        return sha256.hexdigest()
+
+def build_version(name, path, cache):
+    """Hash the files of a version directory"""
+    files = sorted(x.name for x in Path(path).iterdir() if x.is_file())
+    signatures = {f: stat_signature(Path(path, f)) for f in files}
+    digests, combined = _combined_checksum(path, files, signatures, cache)
+
+    version = Version(name)
+    for f in files:
+        version.items[f] = Item(
+            f, _get_type(f), signatures[f][1],
+            digests.get(f) or cache.checksum(str(Path(path, f)),
+                                             signatures[f]))
+    if combined:
+        version.items['lxd.tar.xz'].combined = bytes.fromhex(combined)
+    return version
+
+
+def _build_version(name, path, cache):
+    return build_version(name, path, cache), cache
 
 
 @attr.s
 class Images(object):
+    """The products of the image directory, published as images.json
+
+    With shard set to "os" or "os/arch" the products are published in a
+    file per os (images-<os>.json) or per os and arch
+    (images-<os>-<arch>.json) instead, each listed in index.json, and a
+    save only rewrites the files of the products that changed.
+    """
     path = attr.ib(default=None)
     rebuild = attr.ib(default=False)
+    cache = attr.ib(default=attr.Factory(ChecksumCache))
+    jobs = attr.ib(default=1)
+    executor = attr.ib(default='thread')
+    compressor = attr.ib(default=None)
+    shard = attr.ib(default=None,
+                    validator=attr.validators.in_(SHARDS))
 
     def __attrs_post_init__(self):
+        # Serialized products, only the changed ones are dumped on save
+        self._fragments = {}
+        # Product names of every shard and the shards to check on save,
+        # None for all of them
+        self._shards = {} if self.shard else {'images': {}}
+        self._dirty = None
+        self._updates = {}
+        # Hex digest and size of the files published, by name
+        self._digests = {}
         self.index = Index(self.path, self.rebuild)
-        if not self.path or not Path(self.path).exists() or self.rebuild:
-            self.root = {
-                'format': 'products:1.0',
-                'datatype': 'image-downloads',
-                'content_id': 'images',
-                'products': {}
-            }
+        self.products = Products()
+        self.header = {
+            'format': 'products:1.0',
+            'datatype': 'image-downloads',
+            'content_id': 'images',
+            'products': None
+        }
+        if self.path:
+            for path in self._published_files():
+                # The header keeps the position of the products in the file
+                header = load(path)
+                # Rebuilt files that come out the same keep it, so they
+                # are not written again
+                if 'last_update' in header:
+                    self._updates[header.get('content_id')] = \
+                        header['last_update']
+                if self.rebuild:
+                    continue
+                for name, product in header.get('products', {}).items():
+                    self.products[name] = Product.from_dict(name, product)
+                    self._shards.setdefault(
+                        self._shard_of(name), {})[name] = None
+                header.update(products=None, content_id='images')
+                self.header = header
+        self.index.reset(self._shards)
+
+    def _published_files(self):
+        return [x for x in [Path(self.path, 'images.json')] +
+                sorted(Path(self.path).glob('images-*.json')) if x.exists()]
+
+    def _shard_of(self, name):
+        if not self.shard:
+            return 'images'
+        fields = name.split(':')
+        if self.shard == 'os':
+            return 'images:' + fields[0]
+        return 'images:' + fields[0] + ':' + fields[2 % len(fields)]
+
+    def last_update(self, name):
+        """When the file publishing a product last changed, if known
+
+        Products of files published with another shard setting get the
+        oldest last_update.
+        """
+        return self._updates.get(self._shard_of(name),
+                                 min(self._updates.values(), default=None))
+
+    @property
+    def root(self):
+        """The whole catalogue as a dict, like an unsharded images.json"""
+        header = dict(self.header)
+        if self._updates:
+            header['last_update'] = max(self._updates.values())
         else:
-            with open(str(Path(self.path, 'images.json'))) as json_file:
-                self.root = json.load(json_file)
+            header.pop('last_update', None)
+        return {
+            key: {name: product.to_dict()
+                  for name, product in self.products.items()}
+            if key == 'products' else value
+            for key, value in header.items()
+        }
 
     def update(self, operations):
+        operations = list(operations)
+        with span('hash'):
+            versions = self._build_versions(
+                [op for op in operations
+                 if op.operation == OperationType.ADD_MOD and
+                 not op.is_root])
+        touched = OrderedDict()
         for op in operations:
             if op.is_root:
-                for product in [x for x in self.root['products']
-                                if op.name in x]:
-                    del self.root['products'][product]
+                for product in self.products.under(op.name):
+                    del self.products[product]
+                    self._fragments.pop(product, None)
+                    touched[product] = None
+                self.cache.discard(op.path)
             else:
                 # Always delete for the operations and add if needed
-                if op.name in self.root['products'] and \
-                    op.path.split('/')[-1] in \
-                        self.root['products'][op.name]['versions']:
-                    del self.root['products'][op.name]['versions'][
-                        op.path.split('/')[-1]
-                    ]
-                    if not self.root['products'][op.name]['versions']:
-                        del self.root['products'][op.name]
-                        self.index.delete(op.name)
+                product = self.products.get(op.name)
+                if product and op.path.split('/')[-1] in product.versions:
+                    self._fragments.pop(op.name, None)
+                    del product.versions[op.path.split('/')[-1]]
+                    if not product.versions:
+                        del self.products[op.name]
 
                 if op.operation == OperationType.ADD_MOD:
-                    self._add(op.name, op.path, op.root)
-                    self.index.add(op.name)
-
-    def _add(self, name, path, root):
-        if Path(path).exists():
-            v = Version(path.split('/')[-1], path, root)
-
-            if name not in self.root['products']:
-                fields = name.split(':')
-                self.root['products'].update({
-                    name: {
-                        'versions': {},
-                        'os': fields[0],
-                        'release': fields[1],
-                        'release_title': fields[1],
-                        'arch': fields[2],
-                        'aliases': '/'.join(fields)
-                    }
-                })
-
-            self.root['products'][name]['versions'].update(v.root)
-
-    def to_json(self):
-        return json.dumps(self.root)
+                    self._add(op.name, op.path, versions.get(op.path))
+                else:
+                    self.cache.discard(op.path)
+                touched[op.name] = None
+
+        # A single pass over the index for every shard of the batch
+        shards = {}
+        for name in touched:
+            shards.setdefault(self._shard_of(name), []).append(name)
+        for shard, names in shards.items():
+            members = self._shards.setdefault(shard, {})
+            for name in names:
+                if name in self.products:
+                    members[name] = None
+                else:
+                    members.pop(name, None)
+            if not members and shard != 'images':
+                del self._shards[shard]
+            self.index.update(
+                added=[x for x in names if x in self.products],
+                deleted=[x for x in names if x not in self.products],
+                content_id=shard)
+            if self._dirty is not None:
+                self._dirty.add(shard)
+
+    def _build_versions(self, operations):
+        """Hash the versions in a pool of workers
+
+        Results are returned by path and merged later by update in the
+        order of the operations, so the output does not depend on which
+        worker finishes first.
+        """
+        operations = [op for op in operations if Path(op.path).exists()]
+        if self.jobs <= 1 or len(operations) <= 1:
+            return {}
+
+        use_processes = self.executor == 'process'
+        pool_class = ProcessPoolExecutor if use_processes \
+            else ThreadPoolExecutor
+        with pool_class(max_workers=self.jobs) as pool:
+            futures = {
+                op.path: pool.submit(
+                    _build_version, op.path.split('/')[-1], op.path,
+                    self.cache.subset(op.path) if use_processes
+                    else self.cache)
+                for op in operations
+            }
+
+        versions = {}
+        for path, future in futures.items():
+            versions[path], cache = future.result()
+            if use_processes:
+                self.cache.update(cache)
+        return versions
+
+    def _add(self, name, path, version=None):
+        if version is None and Path(path).exists():
+            with span('hash'):
+                version = build_version(path.split('/')[-1], path,
+                                        self.cache)
+
+        if version is not None:
+            if name not in self.products:
+                self.products[name] = Product.from_name(name)
+            self.products[name].versions[version.name] = version
+            self._fragments.pop(name, None)
+
+    def _chunks(self, shard='images'):
+        """Serialize a products file one product at a time"""
+        products = self.products
+        for name in [x for x in self._fragments if x not in products]:
+            del self._fragments[name]
+
+        header = dict(self.header, content_id=shard)
+        if shard in self._updates:
+            header['last_update'] = self._updates[shard]
+        else:
+            header.pop('last_update', None)
+
+        yield b'{'
+        for i, (key, value) in enumerate(header.items()):
+            yield (b',' if i else b'') + dumps(key) + b':'
+            if key != 'products':
+                yield dumps(value)
+                continue
+            yield b'{'
+            for j, name in enumerate(self._shards.get(shard, ())):
+                if name not in self._fragments:
+                    self._fragments[name] = dumps(products[name].to_dict())
+                yield (b',' if j else b'') + dumps(name) + b':' + \
+                    self._fragments[name]
+            yield b'}'
+        yield b'}'
+
+    def to_json(self, shard='images'):
+        return b''.join(self._chunks(shard)).decode('utf-8')
 
     def save(self):
-        if self.path:
-            with open(str(Path(self.path, 'images.json')), 'w') as outfile:
-                self.root['last_update'] = time.time()
-                json.dump(self.root, outfile)
-        self.index.save()
+        """Publish the products files, index.json and then manifest.json
+
+        Only the shards changed since the last save are serialized, and
+        a file is only written when the digest of its content changed
+        (last_update included), so unchanged files keep their mtime and
+        ETag. Files of shards without products are removed.
+
+        manifest.json lists the digest and size of every published file,
+        so caches and mirrors can validate them without downloading.
+        """
+        start = time.monotonic()
+        digests = dict(self._digests)
+        with Publication() as publication:
+            if self.path:
+                shards = self._shards if self._dirty is None \
+                    else [x for x in self._shards if x in self._dirty]
+                with span('serialize'):
+                    for shard in shards:
+                        digests[products_file(shard)] = \
+                            self._stage(publication, shard)
+                current = set(products_file(x) for x in self._shards)
+                for path in self._published_files():
+                    if path.name not in current:
+                        publication.remove(path)
+                for name in [x for x in digests
+                             if x != 'index.json' and x not in current]:
+                    del digests[name]
+                for shard in [x for x in self._updates
+                              if x not in self._shards]:
+                    del self._updates[shard]
+            self.index.save(publication)
+            if self.path:
+                digests.update((path.name, digest) for path, digest
+                               in publication.digests.items())
+                self._stage_manifest(publication, digests)
+        self._digests = digests
+        self._dirty = set()
+        with span('checksum_cache'):
+            self.cache.save()
+        if self.compressor:
+            self.compressor.submit(publication.published)
+        metrics.SAVE_SECONDS.observe(time.monotonic() - start)
+        for name, (_, size) in digests.items():
+            metrics.PUBLISHED_BYTES.set(size, file=name)
+
+    def _stage(self, publication, shard):
+        """Stage a shard if its content changed, returns its digest
+
+        The digest published by a previous save is kept in memory, so
+        the file is only read on the first save.
+        """
+        path = Path(self.path, products_file(shard))
+        current = hashlib.sha256()
+        size = 0
+        for chunk in self._chunks(shard):
+            current.update(chunk)
+            size += len(chunk)
+        published = self._digests.get(path.name)
+        if published is not None:
+            published = bytes.fromhex(published[0])
+        else:
+            published = file_digest(path)
+        if current.digest() == published:
+            return current.hexdigest(), size
+        self._updates[shard] = time.time()
+        publication.stage(path, self._chunks(shard))
+        return publication.digests[path]
+
+    def _stage_manifest(self, publication, digests):
+        index_path = Path(self.path, 'index.json')
+        if 'index.json' not in digests and index_path.exists():
+            digests['index.json'] = (file_digest(index_path).hex(),
+                                     index_path.stat().st_size)
+        manifest = {
+            'format': 'manifest:1.0',
+            'files': {
+                name: {'sha256': digest, 'size': size}
+                for name, (digest, size) in sorted(digests.items())
+            }
+        }
+        publication.stage(Path(self.path, 'manifest.json'), dumps(manifest))
@@ -1,46 +1,124 @@
-import json
 from pathlib import Path
 import attr
+from lxd_image_server.tools.publish import Publication
+from lxd_image_server.simplestreams.serializer import dumps, load
+
+
+STREAMS_PATH = 'streams/v1'
+
+
+def products_file(content_id):
+    """Name of the products file of a content id (images:ubuntu...)"""
+    return content_id.replace(':', '-') + '.json'
 
 
 @attr.s
 class Index(object):
+    """index.json, listing the products sorted by name
+
+    There is an entry per products file: the default images one and one
+    per shard when the catalogue is sharded. Membership is kept in sets
+    and index.json is only written again when it changed.
+    """
     path = attr.ib(default=None)
     rebuild = attr.ib(default=False)
 
     def __attrs_post_init__(self):
-        if not self.path or not Path(self.path).exists() or self.rebuild:
+        if not self.path or self.rebuild or \
+                not Path(self.path, 'index.json').exists():
             self.root = {
                 'format': 'index:1.0',
                 'index': {
-                    'images': {
-                        'datatype': 'image-downloads',
-                        'path': 'streams/v1/images.json',
-                        'format': 'products:1.0',
-                        'products': []
-                    }
+                    'images': self._entry('images')
                 }
             }
+            self.changed = True
         else:
-            with open(str(Path(self.path, 'index.json'))) as json_file:
-                self.root = json.load(json_file)
+            self.root = load(Path(self.path, 'index.json'))
+            # Indexes listing products unsorted or twice are rewritten
+            self.changed = any(
+                x['products'] != sorted(set(x['products']))
+                for x in self._entries().values())
+        self._products = {
+            content_id: set(entry['products'])
+            for content_id, entry in self._entries().items()
+        }
+
+    @staticmethod
+    def _entry(content_id):
+        return {
+            'datatype': 'image-downloads',
+            'path': STREAMS_PATH + '/' + products_file(content_id),
+            'format': 'products:1.0',
+            'products': []
+        }
+
+    def _entries(self):
+        return {k: v for k, v in self.root['index'].items()
+                if v.get('datatype') == 'image-downloads'}
 
     @property
     def products(self):
-        return self.root['index']['images']['products']
+        return sorted(set().union(*self._products.values()))
+
+    def __contains__(self, product):
+        return any(product in x for x in self._products.values())
 
     def add(self, product):
-        if product not in self.products:
-            self.products.append(product)
+        self.update(added=[product])
 
     def delete(self, product):
-        if product in self.products:
-            self.products.remove(product)
+        self.update(deleted=[product])
+
+    def update(self, added=(), deleted=(), content_id='images'):
+        """Add and delete products in bulk, returns if membership changed
+
+        Entries of shards left without products are removed, the images
+        one is always listed.
+        """
+        products = self._products.get(content_id, set())
+        added = set(added) - products
+        deleted = set(deleted) & products
+        if not added and not deleted:
+            return False
+        products |= added
+        products -= deleted
+        self._products[content_id] = products
+        if not products and content_id != 'images':
+            del self._products[content_id]
+        self.changed = True
+        return True
+
+    def reset(self, shards):
+        """Replace all the entries with shards (content id -> products)"""
+        shards = {k: set(v) for k, v in shards.items()}
+        if shards == self._products:
+            return False
+        self._products = shards
+        self.changed = True
+        return True
+
+    def _dumps(self):
+        index = {k: v for k, v in self.root['index'].items()
+                 if v.get('datatype') != 'image-downloads'}
+        for content_id in sorted(self._products):
+            entry = self.root['index'].get(content_id) or \
+                self._entry(content_id)
+            entry['products'] = sorted(self._products[content_id])
+            index[content_id] = entry
+        self.root['index'] = index
+        return dumps(self.root)
 
     def to_json(self):
-        return json.dumps(self.root)
+        return self._dumps().decode('utf-8')
 
-    def save(self):
-        if self.path:
-            with open(str(Path(self.path, 'index.json')), 'w') as outfile:
-                json.dump(self.root, outfile)
+    def save(self, publication=None):
+        if not self.path or not self.changed:
+            return
+        if publication is None:
+            with Publication() as publication:
+                publication.stage(Path(self.path, 'index.json'),
+                                  self._dumps())
+        else:
+            publication.stage(Path(self.path, 'index.json'), self._dumps())
+        self.changed = False
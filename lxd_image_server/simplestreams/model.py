@@ -0,0 +1,216 @@
+import sys
+from collections.abc import MutableMapping
+
+
+def _digest(value):
+    """Raw bytes of a hex digest, or the value itself if it is not one"""
+    try:
+        return bytes.fromhex(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _hexdigest(value):
+    return value.hex() if isinstance(value, bytes) else value
+
+
+class Item(object):
+    """A file of a version
+
+    Digests are kept as raw bytes and the path only when it is not the
+    default one (images/<product path>/<version>/<name>). Unknown keys
+    found in images.json are kept in extra.
+    """
+    __slots__ = ('name', 'ftype', 'size', 'sha256', 'combined', 'path',
+                 'extra')
+
+    def __init__(self, name, ftype, size, sha256, combined=None, path=None,
+                 extra=None):
+        self.name = name
+        self.ftype = sys.intern(ftype)
+        self.size = size
+        self.sha256 = _digest(sha256)
+        self.combined = _digest(combined) if combined else None
+        self.path = path
+        self.extra = extra or None
+
+    def __eq__(self, other):
+        return isinstance(other, Item) and all(
+            getattr(self, x) == getattr(other, x) for x in self.__slots__)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @classmethod
+    def from_dict(cls, name, data, default_path):
+        data = dict(data)
+        path = data.pop('path', None)
+        return cls(name, data.pop('ftype', name), data.pop('size', None),
+                   data.pop('sha256', None),
+                   data.pop('combined_squashfs_sha256', None),
+                   None if path == default_path else path, data)
+
+    def to_dict(self, default_path):
+        data = {
+            'sha256': _hexdigest(self.sha256),
+            'size': self.size,
+            'path': self.path or default_path,
+            'ftype': self.ftype
+        }
+        if self.combined:
+            data['combined_squashfs_sha256'] = _hexdigest(self.combined)
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class Version(object):
+    __slots__ = ('name', 'items', 'extra')
+
+    def __init__(self, name, items=None, extra=None):
+        self.name = name
+        self.items = items if items is not None else {}
+        self.extra = extra or None
+
+    def __eq__(self, other):
+        return isinstance(other, Version) and all(
+            getattr(self, x) == getattr(other, x) for x in self.__slots__)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @classmethod
+    def from_dict(cls, name, data, product_path):
+        data = dict(data)
+        items = {
+            item: Item.from_dict(
+                item, value, '/'.join((product_path, name, item)))
+            for item, value in data.pop('items', {}).items()
+        }
+        return cls(name, items, data)
+
+    def to_dict(self, product_path):
+        data = {
+            'items': {
+                name: item.to_dict('/'.join((product_path, self.name, name)))
+                for name, item in self.items.items()
+            }
+        }
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class Product(object):
+    """A product (os:release:arch:box) with its versions
+
+    The os, release and arch strings are interned, as they are shared by
+    many products.
+    """
+    __slots__ = ('name', 'os', 'release', 'release_title', 'arch', 'aliases',
+                 'versions', 'extra')
+
+    def __init__(self, name, os, release, release_title, arch, aliases,
+                 versions=None, extra=None):
+        self.name = name
+        self.os = sys.intern(os)
+        self.release = sys.intern(release)
+        self.release_title = sys.intern(release_title)
+        self.arch = sys.intern(arch)
+        self.aliases = aliases
+        self.versions = versions if versions is not None else {}
+        self.extra = extra or None
+
+    @classmethod
+    def from_name(cls, name):
+        fields = name.split(':')
+        return cls(name, fields[0], fields[1], fields[1], fields[2],
+                   '/'.join(fields))
+
+    @property
+    def path(self):
+        """Path of the product relative to the images parent directory"""
+        return '/'.join(['images'] + self.name.split(':'))
+
+    @classmethod
+    def from_dict(cls, name, data):
+        data = dict(data)
+        fields = name.split(':')
+        product = cls(
+            name,
+            data.pop('os', fields[0]),
+            data.pop('release', fields[1 % len(fields)]),
+            data.pop('release_title', fields[1 % len(fields)]),
+            data.pop('arch', fields[2 % len(fields)]),
+            data.pop('aliases', '/'.join(fields)))
+        product.versions = {
+            version: Version.from_dict(version, value, product.path)
+            for version, value in data.pop('versions', {}).items()
+        }
+        product.extra = data or None
+        return product
+
+    def to_dict(self):
+        data = {
+            'versions': {
+                name: version.to_dict(self.path)
+                for name, version in self.versions.items()
+            },
+            'os': self.os,
+            'release': self.release,
+            'release_title': self.release_title,
+            'arch': self.arch,
+            'aliases': self.aliases
+        }
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class Products(MutableMapping):
+    """Products by name, indexed by every os, os:release, os:release:arch...
+
+    under() returns the products of a directory of the image tree without
+    looking at the rest of them.
+    """
+
+    def __init__(self):
+        self._products = {}
+        self._prefixes = {}
+
+    @staticmethod
+    def _prefixes_of(name):
+        fields = name.split(':')
+        return [':'.join(fields[:i]) for i in range(1, len(fields) + 1)]
+
+    def __getitem__(self, name):
+        return self._products[name]
+
+    def __setitem__(self, name, product):
+        if name not in self._products:
+            for prefix in self._prefixes_of(name):
+                self._prefixes.setdefault(prefix, set()).add(name)
+        self._products[name] = product
+
+    def __delitem__(self, name):
+        del self._products[name]
+        for prefix in self._prefixes_of(name):
+            names = self._prefixes[prefix]
+            names.discard(name)
+            if not names:
+                del self._prefixes[prefix]
+
+    def __iter__(self):
+        return iter(self._products)
+
+    def __len__(self):
+        return len(self._products)
+
+    def __contains__(self, name):
+        return name in self._products
+
+    def under(self, prefix):
+        """Names of the products in the directory prefix (os:release...)"""
+        if not prefix:
+            return list(self._products)
+        return sorted(self._prefixes.get(prefix, ()))
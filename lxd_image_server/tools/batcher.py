@@ -0,0 +1,53 @@
+import time
+import queue
+import logging
+from lxd_image_server.tools.operation import Operations
+from lxd_image_server.tools.profiling import span
+
+
+logger = logging.getLogger(__name__)
+
+
+class OperationsBatcher(object):
+    """Coalesces the queued event batches into a single set of operations
+
+    After the first batch arrives, the following ones are merged until the
+    queue stays empty for quiet_period seconds or max_latency seconds have
+    passed since the first one, so a burst of uploads is published once.
+    """
+
+    def __init__(self, event_queue, root, quiet_period=2, max_latency=30,
+                 tree=None):
+        self.event_queue = event_queue
+        self.root = root
+        self.quiet_period = quiet_period
+        self.max_latency = max_latency
+        self.tree = tree
+
+    def next(self, events=None):
+        """Operations of the next event batches
+
+        events is the first batch when already taken from the queue,
+        otherwise it waits for one.
+        """
+        if events is None:
+            events = self.event_queue.get()
+        with span('operations'):
+            operations = Operations(events, self.root, self.tree)
+        batches = 1
+        deadline = time.monotonic() + self.max_latency
+        while True:
+            timeout = min(self.quiet_period, deadline - time.monotonic())
+            if timeout <= 0:
+                break
+            try:
+                with span('coalesce'):
+                    events = self.event_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            with span('operations'):
+                operations.update(Operations(events, self.root, self.tree))
+            batches += 1
+        logger.debug('%d event batches merged in %d operations',
+                     batches, len(operations))
+        return operations
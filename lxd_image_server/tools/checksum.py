@@ -0,0 +1,256 @@
+import os
+import json
+import hashlib
+import time
+import logging
+from pathlib import Path
+from threading import Lock
+from lxd_image_server.tools import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT = 2
+BLOCK_SIZE = 1 << 20
+# Log lines over the entries after which the cache file is rewritten
+COMPACT_SLACK = 1000
+
+
+def sha256_files(filenames, block_size=BLOCK_SIZE):
+    """Hash the files reading each of them only once
+
+    Returns the digest of every file and the digest of all of them
+    concatenated in the given order.
+    """
+    digests = []
+    combined = hashlib.sha256()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    start = time.monotonic()
+    hashed = 0
+    for filename in filenames:
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb', buffering=0) as f:
+            for size in iter(lambda: f.readinto(buf), 0):
+                sha256.update(view[:size])
+                combined.update(view[:size])
+                hashed += size
+        digests.append(sha256.hexdigest())
+
+    elapsed = time.monotonic() - start
+    metrics.HASHED_BYTES.inc(hashed)
+    metrics.HASH_SECONDS.inc(elapsed)
+    if elapsed > 0 and hashed:
+        metrics.HASH_SPEED.set(hashed / elapsed)
+    return digests, combined.hexdigest()
+
+
+def sha256_file(filename, block_size=BLOCK_SIZE):
+    return sha256_files([filename], block_size)[0][0]
+
+
+def stat_signature(path):
+    stat = os.stat(str(path))
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+class ChecksumCache(object):
+    """Checksums indexed by path and validated against (inode, size, mtime).
+
+    Entries are only trusted while the stat signature of the path is the
+    same as when the checksum was stored, so an unchanged file costs a
+    stat() instead of a full read. Without a path the cache lives only in
+    memory.
+
+    Unverified entries hold checksums taken from the published metadata
+    instead of the file content. They tell whether a file changed, but
+    are never used to publish it.
+
+    The file is a log of JSON lines after a header line: every save
+    appends the entries changed since the previous one, or null for
+    removed ones, and the log is rewritten with only the current entries
+    once it grows well past them.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = Lock()
+        self._entries = {}
+        # Changed entries by key, None if removed, not saved yet
+        self._changes = {}
+        self._log_lines = 0
+        self._compact = False
+        if self.path:
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        with self._lock:
+            return {'path': self.path, 'entries': dict(self._entries)}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._lock = Lock()
+        self._entries = state['entries']
+        self._changes = {}
+        self._log_lines = 0
+        self._compact = False
+
+    def load(self):
+        try:
+            with open(str(self.path)) as cache_file:
+                header = json.loads(cache_file.readline())
+                if header.get('format') == 1:
+                    # A whole file of the previous format, rewritten
+                    entries = header.get('entries', {})
+                    compact = True
+                    lines = 0
+                elif header.get('format') == CACHE_FORMAT:
+                    entries, lines, compact = self._replay(cache_file)
+                else:
+                    logger.warning(
+                        'Ignoring checksum cache %s: unknown format',
+                        self.path)
+                    return
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, AttributeError) as error:
+            logger.warning('Ignoring checksum cache %s: %s', self.path, error)
+            return
+        with self._lock:
+            self._entries = entries
+            self._log_lines = lines
+            self._compact = compact or \
+                lines > len(entries) + COMPACT_SLACK
+
+    def _replay(self, cache_file):
+        entries = {}
+        lines = 0
+        for line in cache_file:
+            try:
+                key, entry = json.loads(line)
+            except ValueError:
+                # Cut short by a crash while appending
+                logger.warning('Checksum cache %s truncated', self.path)
+                return entries, lines, True
+            if entry is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = entry
+            lines += 1
+        return entries, lines, False
+
+    def _set(self, key, entry):
+        # Called with the lock held
+        if entry is None:
+            del self._entries[key]
+        else:
+            self._entries[key] = entry
+        self._changes[key] = entry
+
+    def __contains__(self, key):
+        with self._lock:
+            return str(key) in self._entries
+
+    def lookup(self, key, signature, unverified=False):
+        with self._lock:
+            entry = self._entries.get(str(key))
+        if entry and entry[0] == signature and \
+                (unverified or len(entry) == 2):
+            return entry[1]
+        return None
+
+    def store(self, key, signature, digest, verified=True):
+        with self._lock:
+            self._set(str(key), [signature, digest] if verified
+                      else [signature, digest, False])
+
+    def checksum(self, filename, signature=None):
+        signature = signature or stat_signature(filename)
+        digest = self.lookup(filename, signature)
+        if digest is None:
+            digest = sha256_file(str(filename))
+            self.store(filename, signature, digest)
+        return digest
+
+    def subset(self, path):
+        """In-memory copy of the entries under path, to ship to workers"""
+        prefix = str(path).rstrip('/') + '/'
+        subset = ChecksumCache()
+        with self._lock:
+            subset._entries = {
+                k: v for k, v in self._entries.items()
+                if k == str(path) or k.startswith(prefix)}
+        return subset
+
+    def update(self, other):
+        with other._lock:
+            entries = dict(other._entries)
+        with self._lock:
+            for key, entry in entries.items():
+                if self._entries.get(key) != entry:
+                    self._set(key, entry)
+
+    def discard(self, path):
+        prefix = str(path).rstrip('/') + '/'
+        with self._lock:
+            for key in [x for x in self._entries
+                        if x == str(path) or x.startswith(prefix)]:
+                self._set(key, None)
+
+    def evict(self):
+        """Drop the entries of files that no longer exist
+
+        It stats every entry, so it is only run by full updates and
+        reconciles. Batches drop the entries of what they delete with
+        discard().
+        """
+        with self._lock:
+            keys = list(self._entries)
+        for key in keys:
+            if not os.path.exists(key):
+                with self._lock:
+                    if key in self._entries:
+                        self._set(key, None)
+
+    def save(self):
+        """Append the changes since the last save, or rewrite the log"""
+        if not self.path:
+            return
+        with self._lock:
+            if not self._changes and not self._compact:
+                return
+            try:
+                if self._compact or self._log_lines + len(self._changes) > \
+                        len(self._entries) + COMPACT_SLACK:
+                    self._rewrite()
+                else:
+                    self._append()
+            except OSError as error:
+                # The next save writes every entry
+                self._compact = True
+                logger.warning('Fail to save checksum cache %s: %s',
+                               self.path, error)
+            self._changes = {}
+
+    def _rewrite(self):
+        tmp_path = Path(str(self.path) + '.tmp')
+        with open(str(tmp_path), 'w') as cache_file:
+            cache_file.write(json.dumps({'format': CACHE_FORMAT}) + '\n')
+            for key, entry in self._entries.items():
+                cache_file.write(json.dumps([key, entry]) + '\n')
+        os.replace(str(tmp_path), str(self.path))
+        self._log_lines = len(self._entries)
+        self._compact = False
+
+    def _append(self):
+        if not os.path.exists(str(self.path)):
+            self._rewrite()
+            return
+        with open(str(self.path), 'a') as cache_file:
+            cache_file.write(''.join(
+                json.dumps([key, entry]) + '\n'
+                for key, entry in self._changes.items()))
+        self._log_lines += len(self._changes)
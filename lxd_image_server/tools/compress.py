@@ -0,0 +1,137 @@
+import os
+import zlib
+import queue
+import logging
+import threading
+from pathlib import Path
+from lxd_image_server.tools.publish import Publication, commit_lock
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEVELS = {'gz': 9, 'br': 11, 'zst': 19}
+
+
+def _read_chunks(path, block_size=1 << 20):
+    with open(str(path), 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            yield block
+
+
+def gzip_chunks(chunks, level):
+    # wbits=31 writes a gzip header with a zero mtime, so the output only
+    # depends on the input
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def brotli_chunks(chunks, level):
+    compressor = brotli.Compressor(quality=level)
+    for chunk in chunks:
+        yield compressor.process(chunk)
+    yield compressor.finish()
+
+
+def zstd_chunks(chunks, level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+COMPRESSORS = {
+    'gz': gzip_chunks,
+    'br': brotli_chunks,
+    'zst': zstd_chunks
+}
+
+
+class Compressor(object):
+    """Writes pre-compressed sidecars (images.json.gz...) in background
+
+    nginx can serve them with gzip_static (or brotli_static) instead of
+    compressing the document on every request.
+    """
+
+    def __init__(self, formats=('gz',), levels=None):
+        self.levels = dict(DEFAULT_LEVELS, **(levels or {}))
+        self.formats = []
+        for fmt in formats:
+            if fmt not in COMPRESSORS:
+                logger.error('Unknown compression format %s', fmt)
+            elif (fmt == 'br' and brotli is None) or \
+                    (fmt == 'zst' and zstandard is None):
+                logger.warning('Python module for %s compression is not '
+                               'installed, skipping it', fmt)
+            else:
+                self.formats.append(fmt)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def extensions(self):
+        return ['.' + fmt for fmt in self.formats]
+
+    def submit(self, paths):
+        if not self.formats:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='compressor', daemon=True)
+                self._thread.start()
+        for path in paths:
+            self._queue.put(Path(path))
+
+    def join(self):
+        """Wait until every submitted file has been compressed"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            try:
+                self.compress(path)
+            except Exception as error:
+                logger.error('Fail to compress %s: %s', path, error)
+            finally:
+                self._queue.task_done()
+
+    def compress(self, path):
+        try:
+            inode = os.stat(str(path)).st_ino
+        except FileNotFoundError:
+            return
+        for fmt in self.formats:
+            # Compressed copies have no sidecars of their own
+            publication = Publication(sidecars=())
+            publication.stage(
+                Path(str(path) + '.' + fmt),
+                COMPRESSORS[fmt](_read_chunks(path), self.levels[fmt]))
+            # A newer file was published meanwhile, it will be compressed
+            # by its own job. The lock keeps it from being published
+            # between the check and the rename
+            with commit_lock:
+                try:
+                    current = os.stat(str(path)).st_ino
+                except FileNotFoundError:
+                    current = None
+                if current != inode:
+                    publication.abort()
+                    return
+                publication.commit()
+        logger.debug('%s compressed', path)
@@ -0,0 +1,338 @@
+import time
+import signal
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from lxd_image_server.tools import metrics
+from lxd_image_server.tools.mirror import MirrorManager
+from lxd_image_server.tools.operation import Operations
+from lxd_image_server.tools.profiling import Profiler, batch, span
+from lxd_image_server.tools.reconcile import reconcile_operations
+
+
+logger = logging.getLogger(__name__)
+
+# Versions published at a time by the startup reconcile, which stops
+# between them when the service is stopped
+RECONCILE_BATCH = 20
+
+
+class WatchDaemon(object):
+    """Watch service driven by an asyncio event loop
+
+    The inotify descriptor is read as soon as it is readable and the
+    events are turned into operations, published once no event arrived
+    for quiet_period seconds or max_latency seconds after the first one.
+    Publishing (hashing and serializing) runs in an executor thread, a
+    batch at a time, and mirrors are synced with rsync subprocesses, a
+    sync at a time per mirror and mirror_concurrency mirrors at once.
+
+    Reading inotify pauses while max_pending operations wait to be
+    published. SIGTERM and SIGINT stop reading, publish what is pending
+    and wait drain_timeout seconds for the mirrors before killing their
+    rsyncs.
+    """
+
+    def __init__(self, watcher, images, tree, event_filter,
+                 quiet_period=0.25, max_latency=1, max_pending=10000,
+                 mirror_concurrency=4, drain_timeout=300, profiler=None,
+                 reload=None, loop=None):
+        self.watcher = watcher
+        self.images = images
+        self.tree = tree
+        self.event_filter = event_filter
+        self.quiet_period = quiet_period
+        self.max_latency = max_latency
+        self.max_pending = max_pending
+        self.drain_timeout = drain_timeout
+        self.profiler = profiler or Profiler()
+        self.reload = reload
+        self.loop = loop or asyncio.new_event_loop()
+        # Publishing needs a single thread, the one the profiler samples
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.mirror_concurrency = mirror_concurrency
+        self._semaphore = None
+        self._pending = None
+        self._first_event = None
+        self._timer = None
+        self._publishing = None
+        self._reading = False
+        self._stopping = False
+        self._done = None
+        # Mirror and sync task by name. A mirror changed by a reload gets
+        # its own task, the old one stops after its running sync
+        self._mirror_tasks = {}
+        self._syncs = set()
+        self._processes = set()
+        self._killed = False
+        self._backlog = None
+
+    @property
+    def pending(self):
+        return len(self._pending) if self._pending is not None else 0
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        self._done = self.loop.create_future()
+        self._semaphore = asyncio.Semaphore(self.mirror_concurrency)
+        metrics.QUEUE_DEPTH.set_function(lambda: self.pending)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, self.stop)
+        if self.reload is not None:
+            self.loop.add_signal_handler(signal.SIGHUP, self._reload)
+
+        # Watch from the start, the events received meanwhile are kept
+        # until the changes done while the service was stopped are
+        # reconciled, as the tree can't be shared with the reconcile
+        self._backlog = []
+        self._resume()
+        self._read()
+        self._tick()
+        await self.loop.run_in_executor(self.executor, self._reconcile)
+        backlog, self._backlog = self._backlog, None
+        if not self._stopping:
+            # The next start reconciles the backlog otherwise
+            MirrorManager.update_mirror_list(sync=False)
+            self._sync_mirrors()
+            if backlog:
+                self._add(backlog)
+            logger.info('start watching for new images')
+        await self._done
+
+    def stop(self):
+        if self._stopping:
+            return
+        logger.info('Stopping, publishing the pending changes')
+        self._stopping = True
+        self._pause()
+        asyncio.ensure_future(self._drain(), loop=self.loop)
+
+    def _reload(self):
+        logger.info('Reloading configuration')
+        self.reload()
+        MirrorManager.update_mirror_list(sync=False)
+        self._sync_mirrors()
+
+    def _reconcile(self):
+        with batch('reconcile') as timings:
+            with span('reconcile'):
+                operations = reconcile_operations(self.images, self.tree)
+            timings.fields['operations'] = len(operations)
+        if not operations:
+            return
+        ops = list(operations.ops)
+        for i in range(0, len(ops), RECONCILE_BATCH):
+            if self._stopping:
+                # The next start reconciles the rest
+                logger.info('Reconcile stopped, %d versions left',
+                            len(ops) - i)
+                return
+            chunk = ops[i:i + RECONCILE_BATCH]
+            with batch('reconcile') as timings:
+                with span('update'):
+                    self.images.update(chunk)
+                # Saving keeps the checksums of the versions hashed so far
+                with span('save'):
+                    self.images.save()
+                timings.fields['operations'] = len(chunk)
+
+    # Events
+
+    def _resume(self):
+        if not self._reading and not self._stopping:
+            self.loop.add_reader(self.watcher.fileno(), self._read)
+            self._reading = True
+
+    def _pause(self):
+        if self._reading:
+            self.loop.remove_reader(self.watcher.fileno())
+            self._reading = False
+
+    def _tick(self):
+        # Polling fallback when inotify watches are exhausted
+        if self.watcher.polling:
+            self._read()
+        if not self._stopping:
+            self.loop.call_later(1, self._tick)
+
+    def _read(self):
+        if not self._reading:
+            return
+        events = self.watcher.read()
+        if self.watcher.crawling:
+            self.loop.call_soon(self._read)
+        changed = self.event_filter(events)
+        metrics.EVENTS.inc(len(events))
+        metrics.EVENTS_FILTERED.inc(len(events) - len(changed))
+        if not changed:
+            return
+        if self._backlog is not None:
+            self._backlog.extend(changed)
+        else:
+            self._add(changed)
+
+    def _add(self, events):
+        operations = Operations(events, self.tree.root, self.tree)
+        if not operations:
+            return
+        if self._pending is None:
+            self._pending = operations
+            self._first_event = self.loop.time()
+        else:
+            self._pending.update(operations)
+        if self.pending >= self.max_pending:
+            logger.warning('%d operations pending, pausing inotify',
+                           self.pending)
+            self._pause()
+        self._schedule()
+
+    def _schedule(self):
+        """Publish the pending operations once the events stop"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending is None or self._publishing is not None:
+            return
+        delay = min(self.quiet_period,
+                    self._first_event + self.max_latency - self.loop.time())
+        self._timer = self.loop.call_later(max(delay, 0), self._flush)
+
+    # Publishing
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending is None or self._publishing is not None:
+            return
+        operations, self._pending = self._pending, None
+        self._publishing = asyncio.ensure_future(
+            self._publish(operations), loop=self.loop)
+        self._resume()
+
+    async def _publish(self, operations):
+        start = self.loop.time()
+        try:
+            await self.loop.run_in_executor(self.executor, self._update,
+                                            operations)
+        except Exception:
+            logger.exception('Fail to publish %d operations',
+                             len(operations))
+        else:
+            metrics.BATCH_OPERATIONS.observe(len(operations))
+            metrics.BATCH_SECONDS.observe(self.loop.time() - start)
+            self._sync_mirrors(operations.ops)
+        finally:
+            self._publishing = None
+            self._schedule()
+
+    def _update(self, operations):
+        logger.info('Updating server: %s', ','.join(
+            str(x) for x in operations.ops))
+        with batch('watch') as timings:
+            with self.profiler.profile():
+                with span('update'):
+                    self.images.update(operations.ops)
+                with span('save'):
+                    self.images.save()
+            timings.fields['operations'] = len(operations)
+        logger.info('Server updated')
+
+    # Mirrors
+
+    def _sync_mirrors(self, operations=None):
+        mirrors = list(MirrorManager.mirrors.values())
+        if not mirrors:
+            return
+        # The streams as published now, which a later batch may change
+        # before the mirrors are done with the images
+        snapshot = MirrorManager.snapshot()
+        try:
+            for mirror in mirrors:
+                mirror.queue(operations, snapshot)
+                current, task = self._mirror_tasks.get(mirror.name,
+                                                       (None, None))
+                if current is not mirror or task.done():
+                    task = asyncio.ensure_future(self._sync_mirror(mirror),
+                                                 loop=self.loop)
+                    task.add_done_callback(self._syncs.discard)
+                    self._syncs.add(task)
+                    self._mirror_tasks[mirror.name] = (mirror, task)
+        finally:
+            if snapshot is not None:
+                snapshot.release()
+
+    async def _sync_mirror(self, mirror):
+        while not self._killed:
+            pending, operations = mirror.take()
+            if not pending:
+                return
+            async with self._semaphore:
+                start = time.monotonic()
+                try:
+                    synced = True
+                    for args in mirror.commands(operations):
+                        if not await self._rsync(mirror, args):
+                            synced = False
+                            break
+                except Exception as error:
+                    logger.error('Fail to synchronize mirror %s: %s',
+                                 mirror.name, error)
+                    synced = False
+            mirror.record(start, synced, operations)
+
+    async def _rsync(self, mirror, args):
+        command = mirror.rsync_command(args)
+        logger.debug('running: %s', command)
+        start = time.monotonic()
+        process = await asyncio.create_subprocess_exec(*command)
+        self._processes.add(process)
+        if self._killed:
+            process.kill()
+        try:
+            returncode = await process.wait()
+        finally:
+            self._processes.discard(process)
+        mirror.rsync_done(args, returncode, time.monotonic() - start)
+        if returncode:
+            logger.error('Fail to synchronize mirror %s: rsync exited '
+                         'with %d', mirror.name, returncode)
+        return returncode == 0
+
+    # Shutdown
+
+    async def _drain(self):
+        try:
+            if self._publishing is not None:
+                await self._publishing
+            if self._pending is not None:
+                self._flush()
+                await self._publishing
+
+            tasks = list(self._syncs)
+            if tasks:
+                logger.info('Waiting for %d mirrors', len(tasks))
+                _, running = await asyncio.wait(
+                    tasks, timeout=self.drain_timeout)
+                if running:
+                    self._killed = True
+                    for process in list(self._processes):
+                        process.kill()
+                    logger.warning('%d mirrors did not finish in %ds',
+                                   len(running), self.drain_timeout)
+                    await asyncio.wait(running)
+            # Waits for a running reconcile batch without blocking the loop
+            await self.loop.run_in_executor(None, self.executor.shutdown)
+            if self.images.compressor is not None:
+                # No compressed copy is left half written
+                await self.loop.run_in_executor(
+                    None, self.images.compressor.join)
+            logger.info('Stopped')
+        finally:
+            self._done.set_result(None)
@@ -0,0 +1,267 @@
+import os
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'lxd_image_server_'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300, 600)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"')
+                         .replace('\n', r'\n'))
+        for k, v in pairs) + '}'
+
+
+class Metric(object):
+    """A metric of the Prometheus text format, by label values
+
+    Values are kept in memory, so recording them is cheap whether they
+    are exposed or not.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{} needs the labels {}'.format(
+                self.name, ', '.join(self.labels)))
+        return tuple(str(labels[x]) for x in self.labels)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), value)
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, key, extra, value in self.samples():
+            lines.append('{}{} {}'.format(
+                name, _format_labels(self.labels, key, extra),
+                _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """A gauge set explicitly or read from a function when rendered
+
+    The function returns the value, or a dict of values by tuple of label
+    values for gauges with labels.
+    """
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super(Gauge, self).__init__(*args, **kwargs)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def value(self, **labels):
+        return dict(self.samples_by_key()).get(self._key(labels))
+
+    def samples_by_key(self):
+        if self._function is None:
+            with self._lock:
+                return sorted(self._values.items())
+        try:
+            values = self._function()
+        except Exception as error:
+            logger.debug('Fail to read %s: %s', self.name, error)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return sorted((tuple(str(x) for x in k), v)
+                      for k, v in values.items() if v is not None)
+
+    def samples(self):
+        return [(self.name, key, (), value)
+                for key, value in self.samples_by_key()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=None,
+                 registry=None):
+        super(Histogram, self).__init__(name, documentation, labels,
+                                        registry)
+        self.buckets = tuple(sorted(buckets or DEFAULT_BUCKETS)) + \
+            (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0))
+        return counts[-1]
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((self.name + '_bucket', key,
+                                    [('le', _format_value(bound))], count))
+                samples.append((self.name + '_sum', key, (), total))
+                samples.append((self.name + '_count', key, (), counts[-1]))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return ''.join(x.render() for x in metrics)
+
+
+REGISTRY = Registry()
+
+EVENTS = Counter('inotify_events_total', 'Inotify events received')
+EVENTS_FILTERED = Counter(
+    'inotify_events_filtered_total',
+    'Inotify events discarded as they do not change the images')
+QUEUE_DEPTH = Gauge('event_queue_depth',
+                    'Event batches waiting to be published')
+WATCHES = Gauge('inotify_watches', 'Directories watched with inotify')
+BATCH_OPERATIONS = Histogram(
+    'batch_operations', 'Operations published per batch',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000))
+BATCH_SECONDS = Histogram('batch_duration_seconds',
+                          'Time to publish a batch of operations')
+HASHED_BYTES = Counter('hashed_bytes_total', 'Bytes read to hash images')
+HASH_SECONDS = Counter('hash_seconds_total', 'Time spent hashing images')
+HASH_SPEED = Gauge('hash_bytes_per_second',
+                   'Hashing throughput of the last hashed files')
+SAVE_SECONDS = Histogram('save_duration_seconds',
+                         'Time to serialize and publish the streams')
+PUBLISHED_BYTES = Gauge('published_bytes', 'Size of the published files',
+                        labels=['file'])
+RSYNC_SECONDS = Histogram('rsync_duration_seconds',
+                          'Time of the rsyncs to a mirror',
+                          labels=['mirror'])
+RSYNCS = Counter('rsyncs_total', 'rsyncs to a mirror by exit status',
+                 labels=['mirror', 'status'])
+UPLOADS = Counter('uploads_total', 'Files uploaded by status',
+                  labels=['status'])
+UPLOADED_BYTES = Counter('uploaded_bytes_total',
+                         'Bytes uploaded and hashed while written')
+MIRROR_LAG = Gauge('mirror_lag_seconds',
+                   'Age of the oldest change not synced to a mirror',
+                   labels=['mirror'])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(address, port, registry=REGISTRY):
+    """Serve /metrics in a background thread, returns the server"""
+    handler = type('Handler', (_Handler,), {'registry': registry})
+    server = _Server((address, port), handler)
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    logger.info('Serving metrics on %s:%d', *server.server_address[:2])
+    return server
+
+
+def write_textfile(path, registry=REGISTRY):
+    """Write the metrics for the node exporter textfile collector"""
+    tmp_path = os.path.join(os.path.dirname(str(path)),
+                            '.' + os.path.basename(str(path)) + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(registry.render())
+    os.replace(tmp_path, str(path))
+
+
+def start_textfile_writer(path, interval=15, registry=REGISTRY):
+    def run():
+        while True:
+            try:
+                write_textfile(path, registry)
+            except OSError as error:
+                logger.error('Fail to write metrics to %s: %s', path, error)
+            time.sleep(interval)
+    thread = threading.Thread(target=run, name='metrics-textfile',
+                              daemon=True)
+    thread.start()
+    return thread
@@ -1,14 +1,106 @@
+import os
 import re
+import time
+import shutil
 import logging
+import tempfile
 import subprocess
-from threading import Lock
+from collections import OrderedDict
+from threading import BoundedSemaphore, Condition, Lock, Thread
 from pathlib import Path
 import attr
+from lxd_image_server.tools import metrics
 from lxd_image_server.tools.config import Config
 
 
 logger = logging.getLogger(__name__)
 
+# Suffixes of files that are already compressed and are not compressed
+# again by rsync
+SKIP_COMPRESS = ['xz', 'gz', 'bz2', 'squashfs', 'vcdiff', 'qcow2', 'zst']
+SSH_CONTROL_PATH = '/var/run/lxd-image-server/ssh-%C'
+# Syncs of more versions than this sync the whole image directory, so the
+# rsync command line and its filter rules stay short
+MAX_SYNC_VERSIONS = 1000
+# Keys of a mirror configuration used as Mirror attributes
+TRANSFER_OPTIONS = ('compress', 'skip_compress', 'bwlimit', 'partial',
+                    'inplace', 'timeout', 'control_persist')
+
+
+def _rsync_pattern(path):
+    return re.sub(r'([\[\]*?\\])', r'\\\1', path)
+
+
+def _merge(operations, newer):
+    """Operations followed by the newer ones, the newest for every path
+
+    None stands for a full sync, which covers any operation.
+    """
+    if operations is None or newer is None:
+        return None
+    merged = OrderedDict((op.path, op) for op in operations)
+    for op in newer:
+        merged.pop(op.path, None)
+        merged[op.path] = op
+    return list(merged.values())
+
+
+class StreamsSnapshot(object):
+    """Hard links to the published stream files, taken when a sync is queued
+
+    Mirrors push the snapshot instead of the streams directory, which may
+    already list versions published after the sync was queued, whose
+    images it does not include. The snapshot is removed once released by
+    whoever acquired it. Snapshots left by a previous run are removed when
+    the first one is taken.
+    """
+
+    _cleaned = set()
+
+    def __init__(self, streams_dir):
+        streams_dir = Path(streams_dir)
+        root = streams_dir.parent / '.snapshots'
+        if str(root) not in StreamsSnapshot._cleaned:
+            shutil.rmtree(str(root), ignore_errors=True)
+            StreamsSnapshot._cleaned.add(str(root))
+        os.makedirs(str(root), exist_ok=True)
+        self._dir = tempfile.mkdtemp(dir=str(root))
+        self._lock = Lock()
+        self._count = 1
+        # Named as the streams directory, so it is synced in its place
+        self.path = Path(self._dir, streams_dir.name)
+        try:
+            self._link(streams_dir)
+        except BaseException:
+            self.release()
+            raise
+
+    def _link(self, streams_dir):
+        for dirpath, dirnames, filenames in os.walk(str(streams_dir)):
+            dirnames[:] = [x for x in dirnames if not x.startswith('.')]
+            target = self.path / Path(dirpath).relative_to(streams_dir)
+            os.makedirs(str(target))
+            for name in filenames:
+                # Files being written are dot files
+                if name.startswith('.'):
+                    continue
+                try:
+                    os.link(os.path.join(dirpath, name), str(target / name))
+                except FileNotFoundError:
+                    pass
+
+    def acquire(self):
+        with self._lock:
+            self._count += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._count -= 1
+            if self._count:
+                return
+        shutil.rmtree(self._dir, ignore_errors=True)
+
 
 @attr.s
 class Mirror():
@@ -18,25 +110,263 @@ class Mirror():
     url = attr.ib()
     remote = attr.ib()
     img_dir = attr.ib()
+    streams_dir = attr.ib(default=None)
+    compress = attr.ib(default=True)
+    skip_compress = attr.ib(default=attr.Factory(lambda: list(SKIP_COMPRESS)))
+    bwlimit = attr.ib(default=None)
+    partial = attr.ib(default=False)
+    inplace = attr.ib(default=False)
+    timeout = attr.ib(default=None)
+    control_persist = attr.ib(default=None)
 
     def __attrs_post_init__(self):
         self.root = {}
+        self.stats = {
+            'syncs': 0,
+            'failures': 0,
+            'last_duration': None,
+            'last_success': None
+        }
+        self._condition = Condition()
+        self._pending = None
+        self._pending_since = None
+        # Streams snapshots of the pending sync and of the running one
+        self._pending_snapshot = None
+        self._snapshot = None
+        self._unsynced_since = None
+        # Operations of failed syncs, retried first by the next one, which
+        # is a full sync if a full sync failed
+        self._failed = []
+        self._failed_all = False
+        self._stopped = False
+        self._thread = None
+
+    @property
+    def lag(self):
+        """Seconds since the oldest change not synced yet was submitted"""
+        with self._condition:
+            since = self._unsynced_since
+        return time.monotonic() - since if since is not None else 0
+
+    def submit(self, operations=None, snapshot=None):
+        """Queue a sync in the worker thread of the mirror"""
+        with self._condition:
+            self.queue(operations, snapshot)
+            if self._thread is None:
+                self._thread = Thread(target=self._run,
+                                      name='mirror-' + self.name, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def queue(self, operations=None, snapshot=None):
+        """Add a sync to the pending one, to be run by whoever takes it
+
+        A pending sync that did not start yet is merged with the new one,
+        keeping the latest operation for every path and the latest streams
+        snapshot, which lists the images of both.
+        """
+        with self._condition:
+            if snapshot is not None:
+                if self._pending_snapshot is not None:
+                    self._pending_snapshot.release()
+                self._pending_snapshot = snapshot.acquire()
+            if self._unsynced_since is None:
+                self._unsynced_since = time.monotonic()
+            if self._pending_since is None:
+                self._pending = operations
+                self._pending_since = time.monotonic()
+            else:
+                self._pending = _merge(self._pending, operations)
+
+    def take(self):
+        """Take the pending sync: whether there is one and its operations
+
+        The operations of failed syncs are taken along, before the new
+        ones, so the metadata is never synced before their images.
+        """
+        with self._condition:
+            if self._pending_since is None or self._stopped:
+                return False, None
+            if self._failed_all:
+                operations = None
+            else:
+                operations = _merge(self._failed, self._pending)
+            self._pending = self._pending_since = None
+            self._failed = []
+            self._failed_all = False
+            self._release_snapshot()
+            self._snapshot = self._pending_snapshot
+            self._pending_snapshot = None
+            return True, operations
+
+    def record(self, start, synced, operations=None):
+        """Account a sync of operations started at start
+
+        The operations of a failed sync are kept for the next one.
+        """
+        with self._condition:
+            self._release_snapshot()
+            self.stats['syncs'] += 1
+            self.stats['last_duration'] = time.monotonic() - start
+            if synced:
+                self.stats['last_success'] = time.time()
+                self._unsynced_since = self._pending_since
+            else:
+                self.stats['failures'] += 1
+                if operations is None:
+                    self._failed_all = True
+                else:
+                    self._failed = _merge(self._failed, operations)
+        logger.info('Mirror %s synced in %.1fs', self.name,
+                    self.stats['last_duration'])
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            if self._pending_snapshot is not None:
+                self._pending_snapshot.release()
+                self._pending_snapshot = None
+            self._condition.notify()
 
-    def update(self):
-        self._sync_path(self.img_dir)
+    def _release_snapshot(self):
+        if self._snapshot is not None:
+            self._snapshot.release()
+            self._snapshot = None
 
-    def _sync_path(self, op_path):
-        command = ['rsync', '-azh', '-e', '/usr/bin/ssh -i ' + self.key_path +
-                   ' -l ' + self.user, op_path,
-                   self.servername + ':' + str(Path(op_path).parent),
-                   '--delete']
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending_since is None and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                _, operations = self.take()
+
+            # The semaphore of the current configuration, replaced on reload
+            semaphore = MirrorManager._semaphore
+            semaphore.acquire()
+            start = time.monotonic()
+            try:
+                synced = self.update(operations)
+            except Exception as error:
+                logger.error('Fail to synchronize mirror %s: %s',
+                             self.name, error)
+                synced = False
+            finally:
+                semaphore.release()
+            self.record(start, synced, operations)
+
+    def update(self, operations=None):
+        """Sync the images and then the metadata that references them
+
+        Without operations the whole image directory is synced, otherwise
+        only the paths of the operations.
+        """
+        for args in self.commands(operations):
+            if not self._rsync(args):
+                return False
+        return True
+
+    def commands(self, operations=None):
+        """Arguments of the rsyncs of a sync, in the order they must run
+
+        The streams are pushed from the snapshot of the sync taken, if
+        any, otherwise from the streams directory.
+        """
+        commands = []
+        if operations is None or len(operations) > MAX_SYNC_VERSIONS:
+            commands.append(self._path_args(self.img_dir))
+        else:
+            commands.extend(self._operations_args(operations))
+        if self.streams_dir:
+            source = self._snapshot.path if self._snapshot is not None \
+                else self.streams_dir
+            commands.append([
+                str(source),
+                self.servername + ':' + str(Path(self.streams_dir).parent)])
+        return commands
+
+    def _ssh_command(self):
+        command = ['/usr/bin/ssh', '-i', self.key_path, '-l', self.user]
+        if self.control_persist:
+            # Reuse the same connection for the following rsyncs
+            command += ['-o', 'ControlMaster=auto',
+                        '-o', 'ControlPath=' + SSH_CONTROL_PATH,
+                        '-o', 'ControlPersist=' + str(self.control_persist)]
+        if self.timeout:
+            command += ['-o', 'ConnectTimeout=' + str(self.timeout)]
+        return ' '.join(command)
+
+    def _transfer_options(self):
+        options = []
+        if self.compress and self.skip_compress:
+            options.append('--skip-compress=' + '/'.join(self.skip_compress))
+        if self.bwlimit:
+            options.append('--bwlimit=' + str(self.bwlimit))
+        if self.inplace:
+            options.append('--inplace')
+        elif self.partial:
+            # Interrupted transfers are resumed, and the partial files are
+            # kept out of the served directories
+            options.append('--partial-dir=.rsync-partial')
+        if self.timeout:
+            options.append('--timeout=' + str(self.timeout))
+        return options
+
+    def rsync_command(self, args):
+        return ['rsync', '-azh' if self.compress else '-ah',
+                '-e', self._ssh_command()] + \
+            self._transfer_options() + args + ['--delete']
+
+    def _rsync(self, args):
+        command = self.rsync_command(args)
         logger.debug('running: %s', command)
+        start = time.monotonic()
+        result = subprocess.run(command)
+        self.rsync_done(args, result.returncode, time.monotonic() - start)
         try:
-            subprocess.run(command).check_returncode()
+            result.check_returncode()
         except subprocess.CalledProcessError as error:
             logger.error('Fail to synchronize: %s', error)
-        else:
-            logger.info("Path %s synced for mirror %s", op_path, self.name)
+            return False
+        return True
+
+    def rsync_done(self, args, returncode, elapsed):
+        metrics.RSYNC_SECONDS.observe(elapsed, mirror=self.name)
+        metrics.RSYNCS.inc(mirror=self.name, status=returncode)
+        if returncode == 0:
+            logger.info('%s synced for mirror %s', args[-2], self.name)
+
+    def _path_args(self, op_path):
+        return [str(op_path),
+                self.servername + ':' + str(Path(op_path).parent)]
+
+    def _operations_args(self, operations):
+        """Sync only the version directories of the operations
+
+        The filters include the parents of every version and exclude
+        everything else, so rsync neither walks nor deletes other paths,
+        while versions missing locally are deleted in the mirror.
+        """
+        includes = []
+        for op in operations:
+            parts = Path(op.path).relative_to(op.root).parts
+            for i in range(1, len(parts) + 1):
+                pattern = '/' + _rsync_pattern('/'.join(parts[:i])) + \
+                    ('/***' if i == len(parts) else '/')
+                if pattern not in includes:
+                    includes.append(pattern)
+        if not includes:
+            return []
+
+        filters = ['--include=' + x for x in includes]
+        if self.partial and not self.inplace:
+            # The includes match the partial directories of the versions,
+            # which --delete would remove before the rule rsync appends
+            filters.insert(0, '--filter=P .rsync-partial/')
+        img_dir = str(self.img_dir).rstrip('/') + '/'
+        return [filters +
+                ['--exclude=*', img_dir, self.servername + ':' + img_dir]]
 
     @property
     def servername(self):
@@ -51,29 +381,71 @@ class Mirror():
 
 class MirrorManager():
     img_dir = '/var/www/simplestreams/images'
+    streams_dir = None
     mirrors = {}
     _lock = Lock()
+    _semaphore = BoundedSemaphore(4)
 
     @classmethod
-    def update(cls):
+    def update(cls, operations=None):
+        """Queue a sync in every mirror, without waiting for them"""
         logger.info('Updating all mirrors')
         mirrors = {}
         with cls._lock:
             mirrors = cls.mirrors.copy()
-        for _, mirror in cls.mirrors.items():
-            mirror.update()
+        if not mirrors:
+            return
+        snapshot = cls.snapshot()
+        try:
+            for _, mirror in mirrors.items():
+                mirror.submit(operations, snapshot)
+        finally:
+            if snapshot is not None:
+                snapshot.release()
+
+    @classmethod
+    def snapshot(cls):
+        """Snapshot of the published streams, None if there are none"""
+        if not cls.streams_dir:
+            return None
+        try:
+            return StreamsSnapshot(cls.streams_dir)
+        except OSError as error:
+            logger.warning('Fail to snapshot %s, mirrors sync it as it is: '
+                           '%s', cls.streams_dir, error)
+            return None
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            mirrors = cls.mirrors.copy()
+        return {name: dict(mirror.stats, lag=mirror.lag)
+                for name, mirror in mirrors.items()}
 
     @classmethod
-    def update_mirror_list(cls):
+    def update_mirror_list(cls, sync=True):
         with cls._lock:
+            cls._semaphore = BoundedSemaphore(
+                Config.get('mirror_concurrency', 4))
+            mirrors = {}
             for name, mirror in Config.get('mirrors', {}).items():
-                cls.mirrors[name] = Mirror(
+                mirrors[name] = Mirror(
                     name,
                     mirror['user'],
                     mirror['key_path'],
-                    mirror['url'],
+                    mirror.get('url'),
                     mirror.get('remote'),
-                    cls.img_dir
+                    cls.img_dir,
+                    cls.streams_dir,
+                    **{k: mirror[k] for k in TRANSFER_OPTIONS if k in mirror}
                 )
+                # Keep the worker of mirrors that did not change
+                if cls.mirrors.get(name) == mirrors[name]:
+                    mirrors[name] = cls.mirrors[name]
+            for name, mirror in cls.mirrors.items():
+                if mirrors.get(name) is not mirror:
+                    mirror.stop()
+            cls.mirrors = mirrors
             logger.info('Mirror list updated')
-        cls.update()
+        if sync:
+            cls.update()
@@ -1,8 +1,9 @@
-import re
-import os
+from collections import OrderedDict
 from enum import IntEnum
 from pathlib import Path
 import attr
+from lxd_image_server.tools.paths import is_version, resolve_path
+from lxd_image_server.tools.tree import ImageTree
 
 
 def convert_operation(event_types):
@@ -25,10 +26,9 @@ class Operation(object):
         self.path = path
         self.root = root
         self.is_root = is_root
-        if is_root:
-            self.name = ':'.join(Path(path).relative_to(root).parts)
-        else:
-            self.name = ':'.join(Path(path).relative_to(root).parent.parts)
+        info = resolve_path(root, path)
+        self.name = info.product
+        self.version = info.version
         self.operation = operation if isinstance(operation, OperationType) \
             else convert_operation(operation)
 
@@ -51,59 +51,77 @@ class Operation(object):
 
 @attr.s
 class Operations(object):
+    """Operations generated by a list of inotify events
+
+    There is only one operation per path, the one generated by the latest
+    event for it.
+    """
     events = attr.ib()
     root = attr.ib()
+    tree = attr.ib(default=None)
 
     def __attrs_post_init__(self):
-        self.ops = set([])
+        self._ops = OrderedDict()
+        if self.tree is None:
+            self.tree = ImageTree(self.root)
         self._process_events()
 
+    def __len__(self):
+        return len(self._ops)
+
+    @property
+    def ops(self):
+        return list(self._ops.values())
+
+    def add(self, op):
+        self._ops.pop(op.path, None)
+        self._ops[op.path] = op
+
+    def update(self, other):
+        """Merge the operations of a later batch of events"""
+        for op in other.ops:
+            self.add(op)
+
     def _process_events(self):
-        tmp_ops = set([])
+        tmp_ops = OrderedDict()
         for event in self.events:
+            self.tree.apply(event)
 
             # Operations done over directories
             _, actions, parent, name = event
             if 'IN_ISDIR' in actions:
-                if re.match('\d{8}_\d{2}:\d{2}', name):
-                    self.ops.add(
+                if is_version(name):
+                    self.add(
                         Operation(
                             str(Path(parent, name)),
                             actions, self.root))
                 else:
                     if 'IN_MOVED_FROM' not in actions:
-                        tmp_ops.add(
-                            Operation(
-                                str(Path(parent, name)),
-                                actions, self.root))
+                        op = Operation(str(Path(parent, name)),
+                                       actions, self.root)
+                        tmp_ops[op.path] = op
 
                     # Delete operation over non existing path
                     else:
-                        self.ops.add(
+                        self.add(
                             Operation(
                                 str(Path(parent, name)),
                                 actions, self.root, True))
 
             # Only generate operation if it is a final path
-            elif re.match('\d{8}_\d{2}:\d{2}', parent.split('/')[-1]):
+            elif resolve_path(self.root, parent).is_version_dir:
 
                 # Files operations are ADD_MOD unless all files has been
                 # deleted
-                path = Path(parent)
-                if path.exists() and [x for x in path.iterdir()
-                                      if x.is_file()]:
+                if self.tree.files(parent):
                     op = OperationType.ADD_MOD
                 else:
                     op = OperationType.DELETE
 
-                self.ops.add(Operation(parent, op, self.root))
+                self.add(Operation(parent, op, self.root))
 
         # Generate operations for root paths
-        for op in tmp_ops:
-            for root, dirs, _ in os.walk(op.path):
-                for elem in [x for x in dirs
-                             if re.match('\d{8}_\d{2}:\d{2}', x)]:
-                    self.ops.add(
-                        Operation(
-                            str(Path(root, elem)),
-                            op.operation, self.root))
+        for op in tmp_ops.values():
+            for path in self.tree.versions_under(op.path):
+                if path != op.path:
+                    self.add(Operation(path, op.operation, self.root))
@@ -0,0 +1,35 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+
+
+VERSION_PATTERN = re.compile(r'\d{8}_\d{2}:\d{2}')
+
+# product: name of the product (os:release:arch:box) of a version
+#   directory or of the directory itself for any other path
+# version: name of the version directory or None
+PathInfo = namedtuple('PathInfo', ['product', 'version', 'is_version_dir'])
+
+
+def is_version(name):
+    return VERSION_PATTERN.match(name) is not None
+
+
+@lru_cache(maxsize=65536)
+def resolve_path(root, path):
+    """Classify a path under the image directory root
+
+    Results are memoized, as the same directories show up in every
+    event of an upload.
+    """
+    root = str(root).rstrip('/')
+    path = str(path)
+    if path.startswith(root + '/'):
+        parts = [x for x in path[len(root) + 1:].split('/') if x]
+    else:
+        parts = list(Path(path).relative_to(root).parts)
+
+    if parts and is_version(parts[-1]):
+        return PathInfo(':'.join(parts[:-1]), parts[-1], True)
+    return PathInfo(':'.join(parts), None, False)
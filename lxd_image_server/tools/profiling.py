@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import cProfile
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+_local = threading.local()
+
+
+class Timings(object):
+    """Time spent in every stage of a batch, by stage name"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.monotonic()
+        self.spans = {}
+        self.fields = {}
+        self.discarded = False
+
+    def discard(self):
+        self.discarded = True
+
+    def add(self, span, elapsed):
+        self.spans[span] = self.spans.get(span, 0) + elapsed
+
+    def record(self):
+        return dict(self.fields, batch=self.name,
+                    total=round(time.monotonic() - self.start, 6),
+                    spans={k: round(v, 6) for k, v in self.spans.items()})
+
+
+@contextmanager
+def batch(name):
+    """Collect the spans of the current thread, logged as one JSON line
+
+    Fields of the record can be set in the fields of the yielded Timings,
+    and discarded batches are not logged.
+    """
+    timings = _local.timings = Timings(name)
+    try:
+        yield timings
+    finally:
+        _local.timings = None
+        if not timings.discarded:
+            logger.info(json.dumps(timings.record(), sort_keys=True))
+
+
+@contextmanager
+def span(name):
+    """Time a stage of the batch of the current thread, if any"""
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings.add(name, time.monotonic() - start)
+
+
+class Profiler(object):
+    """cProfile and tracemalloc of a worker thread, toggled at runtime
+
+    The worker runs its batches inside profile(), which profiles them
+    while profiling is on. Turning it off writes the cProfile stats
+    (load them with pstats) and the tracemalloc snapshot, plus its top
+    allocations as text, to the dump directory.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profile = None
+        self._dump_dir = None
+
+    @property
+    def active(self):
+        return self._profile is not None
+
+    def toggle(self, dump_dir):
+        """Start or stop profiling, waits for the running batch"""
+        with self._lock:
+            if self._profile is None:
+                self._dump_dir = dump_dir
+                self._profile = cProfile.Profile()
+                tracemalloc.start()
+                logger.warning('Profiling started')
+                return None
+            return self._dump()
+
+    def _dump(self):
+        profile, self._profile = self._profile, None
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        os.makedirs(self._dump_dir, exist_ok=True)
+        prefix = os.path.join(self._dump_dir,
+                              time.strftime('%Y%m%d-%H%M%S'))
+        profile.dump_stats(prefix + '.pstats')
+        snapshot.dump(prefix + '.tracemalloc')
+        with open(prefix + '.tracemalloc.txt', 'w') as f:
+            for stat in snapshot.statistics('lineno')[:50]:
+                f.write(str(stat) + '\n')
+        logger.warning('Profiling stopped, stats written to %s.*', prefix)
+        return prefix
+
+    @contextmanager
+    def profile(self):
+        with self._lock:
+            profile = self._profile
+            if profile is None:
+                yield
+                return
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
@@ -0,0 +1,144 @@
+import os
+import hashlib
+import logging
+from pathlib import Path
+from threading import RLock
+
+
+logger = logging.getLogger(__name__)
+
+# Extensions of every pre-compressed copy the compressor can write
+SIDECARS = ('.gz', '.br', '.zst')
+# Held while renaming, so whoever publishes a sidecar can check that its
+# file is not replaced before the sidecar is in place
+commit_lock = RLock()
+
+
+def file_digest(path, block_size=1 << 20):
+    sha256 = hashlib.sha256()
+    try:
+        with open(str(path), 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha256.update(block)
+    except FileNotFoundError:
+        return None
+    return sha256.digest()
+
+
+def fsync_dir(path):
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Publication(object):
+    """Files published together through temporary files and renames
+
+    Every staged file is written and fsynced next to its destination and
+    nothing is visible until commit, which renames them in the order they
+    were staged. Files whose content did not change are not renamed, so
+    clients and mirrors do not see a new file.
+
+    Sidecars of the published files (.gz, .br and .zst by default) are
+    removed before the rename, whatever formats are configured now, so a
+    stale compressed copy is never served for the new content. Files to
+    remove are removed with their sidecars after the renames, once nothing
+    published refers to them.
+    """
+
+    def __init__(self, sidecars=SIDECARS):
+        self.sidecars = sidecars
+        # Hex digest and size of the content staged for every path
+        self.digests = {}
+        self.staged = []
+        self.removed = []
+        self.published = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.published = self.commit()
+        else:
+            self.abort()
+
+    def stage(self, path, data):
+        """Write data (a string or an iterable of chunks) for path
+
+        Returns whether the content differs from the published one.
+        """
+        path = Path(path)
+        tmp_path = path.with_name('.' + path.name + '.tmp')
+        if isinstance(data, (str, bytes)):
+            data = [data]
+
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with open(str(tmp_path), 'wb') as outfile:
+                for chunk in data:
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode('utf-8')
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    outfile.write(chunk)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+
+        self.digests[path] = (sha256.hexdigest(), size)
+        if sha256.digest() == file_digest(path):
+            logger.debug('%s did not change', path)
+            tmp_path.unlink()
+            return False
+
+        if path.exists():
+            os.chmod(str(tmp_path), path.stat().st_mode & 0o7777)
+        self.staged.append((tmp_path, path))
+        return True
+
+    def remove(self, path):
+        self.removed.append(Path(path))
+
+    def _unlink_sidecars(self, path):
+        for extension in self.sidecars:
+            try:
+                Path(str(path) + extension).unlink()
+            except FileNotFoundError:
+                pass
+
+    def commit(self):
+        published = []
+        with commit_lock:
+            for tmp_path, path in self.staged:
+                self._unlink_sidecars(path)
+                os.replace(str(tmp_path), str(path))
+                published.append(path)
+                logger.debug('%s published', path)
+            for path in self.removed:
+                self._unlink_sidecars(path)
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+                logger.debug('%s removed', path)
+        for directory in set(x.parent for x in published + self.removed):
+            fsync_dir(directory)
+        self.staged = []
+        self.removed = []
+        return published
+
+    def abort(self):
+        for tmp_path, _ in self.staged:
+            try:
+                tmp_path.unlink()
+            except FileNotFoundError:
+                pass
+        self.staged = []
+        self.removed = []
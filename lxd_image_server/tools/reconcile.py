@@ -0,0 +1,83 @@
+import os
+import logging
+from lxd_image_server.tools.checksum import stat_signature
+from lxd_image_server.tools.operation import (Operation, Operations,
+                                              OperationType)
+
+
+logger = logging.getLogger(__name__)
+
+
+def _changed(path, files, items, cache, last_update):
+    if set(files) != set(items):
+        return True
+    unknown = []
+    for name in files:
+        filename = os.path.join(path, name)
+        try:
+            signature = stat_signature(filename)
+        except FileNotFoundError:
+            return True
+        if signature[1] != items[name].size:
+            return True
+        digest = cache.lookup(filename, signature, unverified=True)
+        if digest is not None:
+            if bytes.fromhex(digest) != items[name].sha256:
+                return True
+        elif filename in cache:
+            # Replaced or modified since it was hashed
+            return True
+        elif last_update is None or items[name].sha256 is None or \
+                signature[2] > last_update * 1e9:
+            # Modified after the catalogue was published
+            return True
+        else:
+            unknown.append((filename, signature, items[name].sha256))
+
+    # Not modified since they were published, their checksums are the
+    # published ones, until the files are hashed again
+    for filename, signature, sha256 in unknown:
+        cache.store(filename, signature, sha256.hex(), verified=False)
+    return False
+
+
+def reconcile_operations(images, tree):
+    """Operations needed for images to match the version directories on disk
+
+    Versions are compared by their files names, sizes and mtimes, so
+    only new, changed or vanished versions are hashed again. Files are
+    unchanged if the checksum cache has the published checksum for their
+    inode, size and mtime, or, without any cache entry, if they were not
+    modified after the last update of their products file, which seeds
+    the cache with unverified entries. Entries of files that no longer
+    exist are evicted from the cache.
+    """
+    operations = Operations([], tree.root, tree)
+    advertised = {}
+    last_updates = {}
+    for name, product in images.products.items():
+        for version in product.versions.values():
+            path = os.path.join(tree.root,
+                                *(name.split(':') + [version.name]))
+            advertised[path] = version.items
+            last_updates[path] = images.last_update(name)
+
+    for path in tree.versions_under(tree.root):
+        files = tree.files(path)
+        if path not in advertised:
+            if files:
+                operations.add(
+                    Operation(path, OperationType.ADD_MOD, tree.root))
+        elif not files:
+            operations.add(Operation(path, OperationType.DELETE, tree.root))
+        elif _changed(path, files, advertised[path], images.cache,
+                      last_updates[path]):
+            operations.add(Operation(path, OperationType.ADD_MOD, tree.root))
+
+    for path in advertised:
+        if path not in tree:
+            operations.add(Operation(path, OperationType.DELETE, tree.root))
+
+    images.cache.evict()
+    logger.info('%d versions out of date', len(operations))
+    return operations
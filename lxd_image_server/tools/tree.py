@@ -0,0 +1,101 @@
+import os
+import logging
+from lxd_image_server.tools.paths import is_version
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageTree(object):
+    """In-memory index of the directories under the image directory
+
+    It keeps the subdirectories of every os/release/arch/box directory and
+    the files of every version directory, so operations can be resolved
+    without walking the filesystem. It is kept up to date with apply() for
+    every inotify event, and paths that are not known yet are read from
+    disk with os.scandir the first time they are needed.
+    """
+
+    def __init__(self, root):
+        self.root = str(root).rstrip('/')
+        self.dirs = {}
+        self.versions = {}
+
+    def __contains__(self, path):
+        path = str(path).rstrip('/')
+        return path in self.dirs or path in self.versions
+
+    def scan(self, path=None):
+        path = str(path or self.root).rstrip('/')
+        self.remove(path)
+        self._scan(path)
+
+    def _scan(self, path):
+        try:
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        self._link(path)
+
+        if is_version(os.path.basename(path)):
+            self.versions[path] = set(
+                x.name for x in entries if x.is_file())
+            return
+
+        children = self.dirs[path] = set()
+        for entry in entries:
+            if entry.is_dir():
+                children.add(entry.name)
+                if is_version(entry.name) or not entry.is_symlink():
+                    self._scan(entry.path)
+
+    def _link(self, path):
+        parent, name = os.path.split(path)
+        if parent in self.dirs:
+            self.dirs[parent].add(name)
+
+    def remove(self, path):
+        path = str(path).rstrip('/')
+        self.versions.pop(path, None)
+        for child in self.dirs.pop(path, ()):
+            self.remove(os.path.join(path, child))
+        parent, name = os.path.split(path)
+        if parent in self.dirs:
+            self.dirs[parent].discard(name)
+
+    def files(self, path):
+        """Files of a version directory"""
+        path = str(path).rstrip('/')
+        if path not in self.versions:
+            self.scan(path)
+        return self.versions.get(path, set())
+
+    def versions_under(self, path):
+        """Version directories under path, sorted"""
+        path = str(path).rstrip('/')
+        if path not in self:
+            self.scan(path)
+        if path in self.versions:
+            return [path]
+        versions = []
+        for child in sorted(self.dirs.get(path, ())):
+            versions.extend(self.versions_under(os.path.join(path, child)))
+        return versions
+
+    def apply(self, event):
+        _, actions, parent, name = event
+        path = os.path.join(parent, name)
+        removed = 'IN_DELETE' in actions or 'IN_MOVED_FROM' in actions
+        if 'IN_ISDIR' in actions:
+            if removed:
+                self.remove(path)
+            elif path not in self or 'IN_CREATE' in actions or \
+                    'IN_MOVED_TO' in actions:
+                # Rescan new directories, files may have been added
+                # before they were watched
+                self.scan(path)
+        elif parent in self.versions:
+            if removed:
+                self.versions[parent].discard(name)
+            else:
+                self.versions[parent].add(name)
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import unquote
+from lxd_image_server.tools import metrics
+from lxd_image_server.tools.checksum import BLOCK_SIZE, stat_signature
+from lxd_image_server.tools.paths import is_version
+
+
+logger = logging.getLogger(__name__)
+
+# Versions whose lxd.tar.xz was received, waiting for their squashfs
+MAX_PARTIAL = 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class Uploads(object):
+    """Image files written into the image directory while hashing them
+
+    Every file is streamed into the staging directory, hashed as it is
+    written, and renamed into its version directory once complete, so the
+    watcher only sees whole files. Its checksum is stored in the checksum
+    cache before the rename, which keeps the inode, size and mtime, so
+    publishing the version does not read it again.
+
+    The combined checksum of lxd.tar.xz and the squashfs is computed as
+    well when lxd.tar.xz is uploaded first, continuing its hash with the
+    squashfs content. The staging directory must be in the same
+    filesystem as the image directory.
+    """
+
+    def __init__(self, img_dir, cache, staging_dir=None):
+        self.img_dir = str(Path(img_dir).resolve())
+        self.cache = cache
+        self.staging_dir = str(staging_dir or
+                               Path(self.img_dir).parent / '.uploads')
+        self._lock = threading.Lock()
+        # Version path -> signature of lxd.tar.xz and its hash
+        self._partial = OrderedDict()
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    def destination(self, relpath):
+        """Path of an image file, os/release/arch/box/version/file"""
+        parts = [x for x in str(relpath).split('/') if x]
+        if len(parts) != 6 or not is_version(parts[4]) or \
+                any(is_version(x) for x in parts[:4]) or \
+                any(x.startswith('.') for x in parts):
+            raise UploadError('Not an image file path: {}'.format(relpath))
+        return Path(self.img_dir, *parts)
+
+    def receive(self, relpath, stream, length, sha256=None):
+        """Write length bytes of stream to relpath, returns the checksum
+
+        The upload fails if sha256 is given and the checksum differs.
+        """
+        path = self.destination(relpath)
+        if length < 0:
+            raise UploadError('Invalid length {}'.format(length))
+        version_path = str(path.parent)
+        combined = None
+        if path.name.endswith('.squashfs'):
+            with self._lock:
+                partial = self._partial.get(version_path)
+            if partial is not None:
+                combined = partial[1].copy()
+
+        start = time.monotonic()
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.staging_dir,
+                                        prefix='.' + path.name + '.')
+        try:
+            with open(fd, 'wb') as f:
+                self._copy(stream, f, length, digest, combined)
+            if sha256 and sha256.lower() != digest.hexdigest():
+                raise UploadError('Checksum mismatch for {}: {}'.format(
+                    relpath, digest.hexdigest()))
+            os.chmod(tmp_path, 0o664)
+            signature = stat_signature(tmp_path)
+            self.cache.store(str(path), signature, digest.hexdigest())
+            if combined is not None:
+                self._store_combined(version_path, signature, combined)
+            os.makedirs(version_path, exist_ok=True)
+            os.replace(tmp_path, str(path))
+        except BaseException:
+            metrics.UPLOADS.inc(status='failed')
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        if path.name == 'lxd.tar.xz':
+            with self._lock:
+                self._partial.pop(version_path, None)
+                self._partial[version_path] = (signature, digest.copy())
+                while len(self._partial) > MAX_PARTIAL:
+                    self._partial.popitem(last=False)
+        metrics.UPLOADS.inc(status='ok')
+        metrics.UPLOADED_BYTES.inc(length)
+        logger.info('%s uploaded in %.1fs', path, time.monotonic() - start)
+        return digest.hexdigest()
+
+    def _copy(self, stream, f, length, digest, combined):
+        buf = bytearray(BLOCK_SIZE)
+        view = memoryview(buf)
+        remaining = length
+        while remaining:
+            size = stream.readinto(view[:min(remaining, BLOCK_SIZE)])
+            if not size:
+                raise UploadError('Upload ended {} bytes before its '
+                                  'length'.format(remaining))
+            digest.update(view[:size])
+            if combined is not None:
+                combined.update(view[:size])
+            f.write(view[:size])
+            remaining -= size
+
+    def _store_combined(self, version_path, signature, combined):
+        with self._lock:
+            lxd_signature, _ = self._partial.pop(version_path, (None, None))
+        if lxd_signature is None:
+            return
+        try:
+            current = stat_signature(Path(version_path, 'lxd.tar.xz'))
+        except FileNotFoundError:
+            return
+        if current == lxd_signature:
+            # Keyed as the publisher looks it up, by the pair of files
+            self.cache.store(version_path, [lxd_signature, signature],
+                             combined.hexdigest())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    uploads = None
+
+    def do_PUT(self):
+        if not self.path.startswith('/images/'):
+            self.send_error(404)
+            return
+        if self.headers.get('Content-Length') is None:
+            self.send_error(411)
+            return
+        try:
+            digest = self.uploads.receive(
+                unquote(self.path[len('/images/'):].split('?')[0]),
+                self.rfile, int(self.headers['Content-Length']),
+                self.headers.get('X-Checksum-Sha256'))
+        except (UploadError, ValueError) as error:
+            logger.warning('Upload of %s failed: %s', self.path, error)
+            self.close_connection = True
+            self.send_error(400, str(error))
+            return
+        except OSError as error:
+            logger.error('Upload of %s failed: %s', self.path, error)
+            self.close_connection = True
+            self.send_error(500, str(error))
+            return
+
+        body = json.dumps({'sha256': digest}).encode('utf-8')
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients of a unix socket have no address
+        return str(self.client_address[0]) if self.client_address \
+            else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+        UnixStreamServer.server_bind(self)
+        os.chmod(self.server_address, 0o660)
+
+
+def start_upload_server(listen, uploads):
+    """Serve PUT /images/<path> in a background thread
+
+    listen is host:port or unix:<path> for a unix socket. Returns the
+    server.
+    """
+    handler = type('Handler', (_Handler,), {'uploads': uploads})
+    if listen.startswith('unix:'):
+        server = _UnixServer(listen[len('unix:'):], handler)
+    else:
+        address, _, port = listen.rpartition(':')
+        server = _Server((address or '127.0.0.1', int(port)), handler)
+    threading.Thread(target=server.serve_forever, name='uploads',
+                     daemon=True).start()
+    logger.info('Receiving uploads on %s', listen)
+    return server
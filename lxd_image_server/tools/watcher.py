@@ -0,0 +1,251 @@
+import os
+import time
+import logging
+from collections import deque
+from errno import ENOENT, ENOSPC, ENOTDIR
+import inotify.adapters
+import inotify.calls
+from inotify.constants import (IN_CREATE, IN_DELETE, IN_MOVED_FROM,
+                               IN_MOVED_TO)
+from lxd_image_server.tools.paths import is_version
+
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher(object):
+    """Watches a directory tree adding the inotify watches incrementally
+
+    The root is watched at once and the rest of the tree is crawled a few
+    directories at a time between events, so events are handled from the
+    start. Directories created or moved in are watched as soon as their
+    event arrives and their content is listed to generate the events lost
+    before the watch was added.
+
+    If the watches are exhausted (fs.inotify.max_user_watches), the tree is
+    diffed with os.scandir every poll_interval seconds instead.
+
+    Events are either waited for with batches() or read as they arrive
+    with read(), when fileno() is readable in an event loop.
+    """
+
+    def __init__(self, root, mask, crawl_step=256, poll_interval=60):
+        self.root = str(root).rstrip('/')
+        self.mask = mask | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+        self.crawl_step = crawl_step
+        self.poll_interval = poll_interval
+        self.crawl_time = None
+        self.polling = False
+        self._watched = set()
+        self._crawl_queue = deque([(self.root, False)])
+        self._crawl_start = time.monotonic()
+        self._snapshot = None
+        self._last_poll = None
+        self._nonblocking = False
+        self._inotify = inotify.adapters.Inotify(
+            block_duration_s=lambda: 0 if self.crawling or
+            self._nonblocking else 1)
+
+    @property
+    def watch_count(self):
+        return len(self._watched)
+
+    @property
+    def crawling(self):
+        return bool(self._crawl_queue) and not self.polling
+
+    def fileno(self):
+        # The inotify descriptor, which the adapter does not expose. Its
+        # name is private to inotify, pinned in requirements.txt
+        return self._inotify._Inotify__inotify_fd
+
+    def stats(self):
+        return {
+            'watches': self.watch_count,
+            'crawl_time': self.crawl_time,
+            'crawl_pending': len(self._crawl_queue),
+            'polling': self.polling
+        }
+
+    def batches(self, timeout_s=15):
+        """Yield the events received until none arrives for timeout_s"""
+        events = []
+        last_event = time.monotonic()
+        generator = self._inotify.event_gen(yield_nones=True)
+        while True:
+            events.extend(self._crawl())
+            events.extend(self._poll())
+            try:
+                event = next(generator)
+            except inotify.adapters.TerminalEventException as error:
+                events.append(self._rescan_event(error))
+                generator = self._inotify.event_gen(yield_nones=True)
+                continue
+
+            if event is not None:
+                events.extend(self._handle(event))
+                last_event = time.monotonic()
+            elif events and time.monotonic() - last_event > timeout_s:
+                yield events
+                events = []
+
+    def read(self):
+        """Events received so far, without blocking
+
+        The crawl goes on a step per call while crawling is true.
+        """
+        self._nonblocking = True
+        events = self._crawl() + self._poll()
+        received = True
+        try:
+            for event in self._inotify.event_gen(yield_nones=True):
+                if event is not None:
+                    events.extend(self._handle(event))
+                    received = True
+                elif not received:
+                    break
+                else:
+                    # Read again until a poll returns nothing
+                    received = False
+        except inotify.adapters.TerminalEventException as error:
+            events.append(self._rescan_event(error))
+        return events
+
+    def _rescan_event(self, error):
+        # Events were lost, make the whole tree be updated
+        logger.warning('Inotify stopped with %s, rescanning %s',
+                       error, self.root)
+        return (None, ['IN_ISDIR', 'IN_CREATE'],
+                os.path.dirname(self.root), os.path.basename(self.root))
+
+    def _handle(self, event):
+        _, actions, parent, name = event
+        if 'IN_ISDIR' not in actions:
+            return [event]
+
+        path = os.path.join(parent, name)
+        if 'IN_CREATE' in actions or 'IN_MOVED_TO' in actions:
+            if self.polling:
+                # No watches left, polling finds the changes in it
+                return [event]
+            # Watch it before anything else, it may be filled right now
+            self._crawl_queue.appendleft((path, True))
+            return [event] + self._crawl(until=path)
+        if 'IN_DELETE' in actions or 'IN_MOVED_FROM' in actions:
+            prefix = path + '/'
+            for watched in [x for x in self._watched
+                            if x == path or x.startswith(prefix)]:
+                self._watched.discard(watched)
+                try:
+                    # Deleted directories lose their watch by themselves
+                    self._inotify.remove_watch(
+                        watched, superficial='IN_DELETE' in actions)
+                except (inotify.calls.InotifyError, KeyError):
+                    pass
+        return [event]
+
+    def _crawl(self, until=None):
+        """Watch the next directories of the crawl
+
+        Directories found in created ones are crawled at once (until
+        the subtree of until is done) and generate events for their
+        content. Returns those events.
+        """
+        events = []
+        crawled = 0
+        while self._crawl_queue and not self.polling:
+            if until is None and crawled >= self.crawl_step:
+                break
+            if until is not None and self._crawl_queue[0][0] != until and \
+                    not self._crawl_queue[0][0].startswith(until + '/'):
+                break
+            path, new = self._crawl_queue.popleft()
+            crawled += 1
+            if not self._add_watch(path):
+                continue
+            try:
+                entries = list(os.scandir(path))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    self._crawl_queue.appendleft((entry.path, new))
+                    if new:
+                        events.append((None, ['IN_ISDIR', 'IN_CREATE'],
+                                       path, entry.name))
+                elif new and entry.is_file():
+                    events.append((None, ['IN_CLOSE_WRITE'],
+                                   path, entry.name))
+
+        if not self._crawl_queue and self.crawl_time is None:
+            self.crawl_time = time.monotonic() - self._crawl_start
+            logger.info('%d directories watched in %.1fs',
+                        self.watch_count, self.crawl_time)
+        return events
+
+    def _add_watch(self, path):
+        if path in self._watched:
+            return True
+        try:
+            self._inotify.add_watch(path, self.mask)
+        except inotify.calls.InotifyError as error:
+            if error.errno == ENOSPC:
+                self._start_polling()
+            elif error.errno not in (ENOENT, ENOTDIR):
+                raise
+            return False
+        self._watched.add(path)
+        return True
+
+    def _start_polling(self):
+        logger.warning('Inotify watches exhausted after %d directories, '
+                       'checking %s for changes every %ds', self.watch_count,
+                       self.root, self.poll_interval)
+        self.polling = True
+        self._crawl_queue.clear()
+        if self.crawl_time is None:
+            self.crawl_time = time.monotonic() - self._crawl_start
+        self._snapshot = self._scan()
+        self._last_poll = time.monotonic()
+
+    def _poll(self):
+        if not self.polling or \
+                time.monotonic() - self._last_poll < self.poll_interval:
+            return []
+        self._last_poll = time.monotonic()
+        snapshot = self._scan()
+        events = []
+        for path, files in snapshot.items():
+            if self._snapshot.get(path) != files:
+                events.append((None, ['IN_ISDIR', 'IN_MOVED_TO'])
+                              + os.path.split(path))
+        for path in self._snapshot:
+            if path not in snapshot:
+                events.append((None, ['IN_ISDIR', 'IN_MOVED_FROM'])
+                              + os.path.split(path))
+        self._snapshot = snapshot
+        return events
+
+    def _scan(self):
+        """Name, size and mtime of the files of every version directory"""
+        versions = {}
+        pending = [self.root]
+        while pending:
+            try:
+                entries = list(os.scandir(pending.pop()))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                if not is_version(entry.name):
+                    if not entry.is_symlink():
+                        pending.append(entry.path)
+                    continue
+                try:
+                    versions[entry.path] = sorted(
+                        (x.name, x.stat().st_size, x.stat().st_mtime_ns)
+                        for x in os.scandir(entry.path) if x.is_file())
+                except FileNotFoundError:
+                    pass
+        return versions
@@ -0,0 +1,44 @@
+import os
+from pathlib import Path
+
+
+OSES = ['ubuntu', 'debian', 'centos', 'alpine', 'fedora']
+ARCHES = ['amd64', 'arm64', 'i386']
+FILES = ['lxd.tar.xz', 'rootfs.squashfs']
+
+
+def product_paths(products):
+    """os/release/arch/box of every product, spread over a few oses"""
+    for i in range(products):
+        yield Path(OSES[i % len(OSES)], 'release{}'.format(i // 15 % 20),
+                   ARCHES[i % len(ARCHES)], 'box{}'.format(i))
+
+
+def version_name(i):
+    return '2018{:02d}{:02d}_{:02d}:{:02d}'.format(
+        i // 28 % 12 + 1, i % 28 + 1, i // 60 % 24, i % 60)
+
+
+def write_file(path, size):
+    """Sparse file of size bytes, unique per path so digests differ"""
+    with open(str(path), 'wb') as f:
+        f.write(str(path).encode('utf-8'))
+        f.truncate(max(size, f.tell()))
+
+
+def generate_version(path, files=2, size=1 << 20):
+    os.makedirs(str(path), exist_ok=True)
+    names = FILES + ['delta-{}.vcdiff'.format(i) for i in range(files)]
+    for name in names[:max(files, 1)]:
+        write_file(Path(path, name), size)
+    return path
+
+
+def generate_tree(img_dir, products=100, versions=3, files=2, size=1 << 20):
+    """Synthetic image directory, returns the version directories"""
+    paths = []
+    for product in product_paths(products):
+        for i in range(versions):
+            paths.append(generate_version(
+                Path(img_dir, product, version_name(i)), files, size))
+    return paths
@@ -0,0 +1,258 @@
+"""Benchmarks of the update pipeline over synthetic image directories
+
+    python -m test.benchmark.run --products 200 --output baseline.json
+    python -m test.benchmark.run --products 200 --compare baseline.json
+
+Every benchmark runs in its own process, so peak RSS is its own.
+Results are written as JSON, and --compare reports the change of every
+metric against a previous run and fails if one got worse than the
+tolerance.
+"""
+import sys
+import json
+import time
+import logging
+import platform
+import resource
+import tempfile
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import click
+from lxd_image_server import cli as server_cli
+from lxd_image_server.simplestreams.images import Images
+from lxd_image_server.tools.config import Config
+from lxd_image_server.tools.operation import Operations
+from lxd_image_server.tools.tree import ImageTree
+from test.benchmark.generate import (generate_tree, generate_version,
+                                     product_paths, version_name)
+
+
+FORMAT = 1
+# Metrics where a lower value is better, the rest are throughputs
+LOWER_IS_BETTER = ('seconds', 'rss_kb', 'json_bytes')
+
+
+def _configure(params):
+    Config.data = {
+        'hashing': {'jobs': params['jobs'], 'executor': 'thread'},
+        'compression': {'formats': []},
+        'streams': {'shard': params['shard']}
+    }
+    logging.getLogger('lxd_image_server').setLevel(logging.WARNING)
+
+
+def _publish(img_dir, streams_dir):
+    with click.Context(server_cli.update) as ctx:
+        ctx.invoke(server_cli.update, img_dir=Path(img_dir),
+                   streams_dir=str(streams_dir))
+
+
+def _json_bytes(streams_dir):
+    return sum(x.stat().st_size for x in Path(streams_dir).glob('*.json'))
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_update(params, workdir):
+    """Full update command over the whole tree"""
+    _configure(params)
+    img_dir = Path(workdir, 'images')
+    streams_dir = Path(workdir, 'streams', 'v1')
+    streams_dir.mkdir(parents=True)
+    versions = generate_tree(img_dir, params['products'], params['versions'],
+                             params['files'], params['size'])
+    hashed = sum(x.stat().st_size for v in versions for x in v.iterdir())
+
+    start = time.perf_counter()
+    _publish(img_dir, streams_dir)
+    elapsed = time.perf_counter() - start
+    return {
+        'seconds': elapsed,
+        'versions_per_s': len(versions) / elapsed,
+        'hash_mb_per_s': hashed / elapsed / (1 << 20),
+        'json_bytes': _json_bytes(streams_dir),
+        'peak_rss_kb': _peak_rss_kb()
+    }
+
+
+def _version_events(path):
+    """Events the watcher sends for a version directory filled at once"""
+    events = [(None, ['IN_ISDIR', 'IN_CREATE'], str(path.parent), path.name)]
+    for f in sorted(path.iterdir()):
+        events.append((None, ['IN_CLOSE_WRITE'], str(path), f.name))
+    return events
+
+
+def bench_incremental(params, workdir):
+    """Batches of new versions through Operations, Images.update and save"""
+    _configure(params)
+    img_dir = Path(workdir, 'images')
+    streams_dir = Path(workdir, 'streams', 'v1')
+    streams_dir.mkdir(parents=True)
+    generate_tree(img_dir, params['products'], params['versions'],
+                  params['files'], params['size'])
+    _publish(img_dir, streams_dir)
+
+    root = str(img_dir)
+    tree = ImageTree(root)
+    tree.scan()
+    images = Images(str(streams_dir), shard=params['shard'] or None)
+    products = list(product_paths(params['products']))
+    latencies = []
+    for batch in range(params['batches']):
+        events = []
+        for i in range(params['batch_size']):
+            product = products[(batch * params['batch_size'] + i) %
+                               len(products)]
+            path = generate_version(
+                Path(img_dir, product,
+                     version_name(params['versions'] + batch)),
+                params['files'], params['size'])
+            events.extend(_version_events(path))
+
+        start = time.perf_counter()
+        operations = Operations(events, root, tree)
+        images.update(operations.ops)
+        images.save()
+        latencies.append(time.perf_counter() - start)
+
+    total = sum(latencies)
+    return {
+        'seconds': total,
+        'batch_mean_seconds': statistics.mean(latencies),
+        'batch_median_seconds': statistics.median(latencies),
+        'batch_max_seconds': max(latencies),
+        'versions_per_s':
+            params['batches'] * params['batch_size'] / total,
+        'json_bytes': _json_bytes(streams_dir),
+        'peak_rss_kb': _peak_rss_kb()
+    }
+
+
+def bench_needs_update(params, workdir):
+    """Classification of raw inotify events"""
+    _configure(params)
+    kinds = [['IN_CLOSE_WRITE'], ['IN_ATTRIB'], ['IN_ISDIR', 'IN_CREATE'],
+             ['IN_MOVED_TO'], ['IN_ISDIR', 'IN_DELETE'], ['IN_MODIFY']]
+    events = [
+        (None, kinds[i % len(kinds)],
+         '/var/www/simplestreams/images/ubuntu/xenial/amd64/default',
+         version_name(i) if 'IN_ISDIR' in kinds[i % len(kinds)]
+         else 'rootfs.squashfs')
+        for i in range(params['events'])
+    ]
+    start = time.perf_counter()
+    kept = server_cli.needs_update(events)
+    elapsed = time.perf_counter() - start
+    return {
+        'seconds': elapsed,
+        'events_per_s': len(events) / elapsed,
+        'kept': len(kept),
+        'peak_rss_kb': _peak_rss_kb()
+    }
+
+
+BENCHMARKS = {
+    'update': bench_update,
+    'incremental': bench_incremental,
+    'needs_update': bench_needs_update
+}
+
+
+def _run(name, params):
+    with tempfile.TemporaryDirectory() as workdir:
+        return BENCHMARKS[name](params, workdir)
+
+
+def run(names, params):
+    results = {}
+    for name in names:
+        # A new process per benchmark, so peak RSS is not shared
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            results[name] = pool.submit(_run, name, params).result()
+    return {
+        'format': FORMAT,
+        'created': time.time(),
+        'python': platform.python_version(),
+        'params': params,
+        'results': results
+    }
+
+
+def compare(current, baseline, tolerance):
+    """Lines describing every metric change, and the regressions"""
+    lines = []
+    regressions = []
+    if baseline.get('params') != current['params']:
+        lines.append('warning: the baseline was run with other parameters')
+    for name, metrics in sorted(current['results'].items()):
+        for metric, value in sorted(metrics.items()):
+            old = baseline.get('results', {}).get(name, {}).get(metric)
+            if not old or metric == 'kept':
+                continue
+            ratio = value / old
+            worse = ratio - 1 if metric.endswith(LOWER_IS_BETTER) \
+                else 1 - ratio
+            line = '{}.{}: {:.4g} -> {:.4g} ({:+.1%})'.format(
+                name, metric, old, value, ratio - 1)
+            lines.append(line)
+            if worse > tolerance:
+                regressions.append(line)
+    return lines, regressions
+
+
+@click.command()
+@click.option('--products', default=100, show_default=True)
+@click.option('--versions', default=3, show_default=True,
+              help='Versions per product')
+@click.option('--files', default=2, show_default=True,
+              help='Files per version')
+@click.option('--size', default=1 << 20, show_default=True,
+              help='Bytes per file (sparse)')
+@click.option('--jobs', default=1, show_default=True,
+              help='Hashing workers')
+@click.option('--shard', type=click.Choice(['', 'os', 'os/arch']),
+              default='', help='Sharding of the products files')
+@click.option('--batches', default=10, show_default=True,
+              help='Incremental batches')
+@click.option('--batch-size', default=5, show_default=True,
+              help='New versions per incremental batch')
+@click.option('--events', default=100000, show_default=True,
+              help='Events classified by needs_update')
+@click.option('--only', multiple=True, type=click.Choice(sorted(BENCHMARKS)),
+              help='Run only these benchmarks')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Write the results to this file')
+@click.option('--compare', 'baseline', type=click.File(),
+              help='Compare the results with a previous output')
+@click.option('--tolerance', default=0.2, show_default=True,
+              help='Relative change of a metric considered a regression')
+def main(products, versions, files, size, jobs, shard, batches, batch_size,
+         events, only, output, baseline, tolerance):
+    params = {
+        'products': products, 'versions': versions, 'files': files,
+        'size': size, 'jobs': jobs, 'shard': shard, 'batches': batches,
+        'batch_size': batch_size, 'events': events
+    }
+    results = run(only or sorted(BENCHMARKS), params)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline is None:
+        click.echo(json.dumps(results['results'], indent=2, sort_keys=True))
+        return
+
+    lines, regressions = compare(results, json.load(baseline), tolerance)
+    for line in lines:
+        click.echo(line)
+    if regressions:
+        click.echo('{} regressions over {:.0%}'.format(
+            len(regressions), tolerance))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
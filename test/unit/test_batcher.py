@@ -0,0 +1,58 @@
+import os
+import queue
+import tempfile
+from pathlib import Path
+from lxd_image_server.tools.batcher import OperationsBatcher
+from lxd_image_server.tools.operation import Operation, OperationType
+from lxd_image_server.tools.profiling import batch
+
+
+class TestOperationsBatcher(object):
+
+    def test_merge_batches(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = str(
+                Path(tmpdir, 'iats/xenial/amd64/default/20180710_12:00'))
+            other_path = str(
+                Path(tmpdir, 'iats/xenial/amd64/default/20180710_13:00'))
+            os.makedirs(path)
+            Path(path, 'lxd.tar.xz').touch()
+            event_queue = queue.Queue()
+            event_queue.put([
+                (None, ['IN_ISDIR', 'IN_MOVED_FROM'],
+                    str(Path(path).parent), '20180710_12:00'),
+                (None, ['IN_ISDIR', 'IN_MOVED_FROM'],
+                    str(Path(path).parent), '20180710_13:00')
+            ])
+            event_queue.put([
+                (None, ['IN_ISDIR', 'IN_MOVED_TO'],
+                    str(Path(path).parent), '20180710_12:00')
+            ])
+
+            batcher = OperationsBatcher(event_queue, tmpdir, 0.01, 1)
+            operations = batcher.next()
+            assert operations.ops == [
+                Operation(other_path, OperationType.DELETE, tmpdir),
+                Operation(path, OperationType.ADD_MOD, tmpdir)
+            ]
+            assert event_queue.empty()
+
+    def test_max_latency(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            event_queue = queue.Queue()
+            event_queue.put([])
+            event_queue.put([])
+            batcher = OperationsBatcher(event_queue, tmpdir, 1, 0)
+            assert len(batcher.next()) == 0
+            assert event_queue.qsize() == 1
+
+    def test_batch_not_timed_while_waiting(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            event_queue = queue.Queue()
+            event_queue.put([])
+            batcher = OperationsBatcher(event_queue, tmpdir, 0.01, 1)
+            events = event_queue.get()
+            with batch('watch') as timings:
+                assert len(batcher.next(events)) == 0
+            assert set(timings.spans) == {'operations', 'coalesce'}
+            assert event_queue.empty()
@@ -0,0 +1,147 @@
+import os
+import json
+import tempfile
+from pathlib import Path
+from mock import patch
+from lxd_image_server.tools import checksum
+from lxd_image_server.tools.checksum import ChecksumCache, sha256_file
+
+
+SHA_A = '55ee740f58335c97d42c32125218eb7c325fbe34206912f1aa7af7fd6580c9a1'
+
+
+class TestChecksumCache(object):
+
+    def _write(self, path, data='AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'):
+        with open(str(path), 'w') as f:
+            f.write(data)
+
+    def test_checksum(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'lxd.tar.xz')
+            self._write(path)
+            assert ChecksumCache().checksum(path) == SHA_A
+            assert sha256_file(str(path)) == SHA_A
+
+    @patch('lxd_image_server.tools.checksum.sha256_file')
+    def test_unchanged_file_not_hashed(self, sha_mock):
+        sha_mock.return_value = SHA_A
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'lxd.tar.xz')
+            self._write(path)
+            cache = ChecksumCache()
+            cache.checksum(path)
+            cache.checksum(path)
+            assert sha_mock.call_count == 1
+
+    def test_changed_file_hashed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'lxd.tar.xz')
+            self._write(path)
+            cache = ChecksumCache()
+            cache.checksum(path)
+            self._write(path, 'BBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB')
+            assert cache.checksum(path) == sha256_file(str(path))
+            assert cache.checksum(path) != SHA_A
+
+    @patch('lxd_image_server.tools.checksum.sha256_file')
+    def test_persistence(self, sha_mock):
+        sha_mock.return_value = SHA_A
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'lxd.tar.xz')
+            self._write(path)
+            cache_path = Path(tmpdir, 'checksums.json')
+            cache = ChecksumCache(cache_path)
+            cache.checksum(path)
+            cache.save()
+
+            assert ChecksumCache(cache_path).checksum(path) == SHA_A
+            assert sha_mock.call_count == 1
+
+    def test_evict_deleted(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'lxd.tar.xz')
+            self._write(path)
+            cache_path = Path(tmpdir, 'checksums.json')
+            cache = ChecksumCache(cache_path)
+            cache.checksum(path)
+            os.remove(str(path))
+            cache.save()
+            # Saving does not stat every entry
+            assert len(ChecksumCache(cache_path)) == 1
+            cache.evict()
+            cache.save()
+            assert len(ChecksumCache(cache_path)) == 0
+
+    def test_discard(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            version = Path(tmpdir, '20180620_12:18')
+            os.makedirs(str(version))
+            self._write(version / 'lxd.tar.xz')
+            self._write(Path(tmpdir, 'other'))
+            cache = ChecksumCache()
+            cache.checksum(version / 'lxd.tar.xz')
+            cache.checksum(Path(tmpdir, 'other'))
+            cache.discard(version)
+            assert len(cache) == 1
+
+    def test_save_appends_changes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = Path(tmpdir, 'checksums.json')
+            cache = ChecksumCache(cache_path)
+            for name in ('a', 'b', 'c'):
+                cache.store(Path(tmpdir, name), [1, 2, 3], SHA_A)
+            cache.save()
+            inode = os.stat(str(cache_path)).st_ino
+
+            cache.store(Path(tmpdir, 'd'), [1, 2, 3], SHA_A)
+            cache.discard(Path(tmpdir, 'a'))
+            cache.save()
+            cache.save()
+
+            # Only the changes were appended to the same file
+            assert os.stat(str(cache_path)).st_ino == inode
+            assert len(cache_path.read_text().splitlines()) == 6
+            loaded = ChecksumCache(cache_path)
+            assert len(loaded) == 3
+            assert str(Path(tmpdir, 'a')) not in loaded
+            assert loaded.lookup(Path(tmpdir, 'd'), [1, 2, 3]) == SHA_A
+
+    @patch.object(checksum, 'COMPACT_SLACK', 2)
+    def test_log_compacted(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = Path(tmpdir, 'checksums.json')
+            cache = ChecksumCache(cache_path)
+            for i in range(4):
+                cache.store(Path(tmpdir, 'a'), [1, 2, i], SHA_A)
+                cache.save()
+            # Rewritten with its only entry
+            assert len(cache_path.read_text().splitlines()) == 2
+            assert ChecksumCache(cache_path).lookup(
+                Path(tmpdir, 'a'), [1, 2, 3]) == SHA_A
+
+    def test_previous_format(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = Path(tmpdir, 'checksums.json')
+            cache_path.write_text(json.dumps({
+                'format': 1, 'entries': {'/a': [[1, 2, 3], SHA_A]}}))
+            cache = ChecksumCache(cache_path)
+            assert cache.lookup('/a', [1, 2, 3]) == SHA_A
+            cache.save()
+            assert ChecksumCache(cache_path).lookup('/a', [1, 2, 3]) == SHA_A
+            assert json.loads(cache_path.read_text().splitlines()[0]) == \
+                {'format': checksum.CACHE_FORMAT}
+
+    def test_truncated_log(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = Path(tmpdir, 'checksums.json')
+            cache = ChecksumCache(cache_path)
+            cache.store('/a', [1, 2, 3], SHA_A)
+            cache.save()
+            with open(str(cache_path), 'a') as f:
+                f.write('["/b", [[1, 2')
+
+            cache = ChecksumCache(cache_path)
+            assert len(cache) == 1
+            cache.save()
+            assert len(cache_path.read_text().splitlines()) == 2
@@ -0,0 +1,53 @@
+import os
+import gzip
+import tempfile
+import threading
+from pathlib import Path
+from lxd_image_server.tools.compress import Compressor
+from lxd_image_server.tools.publish import Publication, commit_lock
+
+
+class TestCompressor(object):
+
+    def test_compress(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'images.json')
+            path.write_text('{"products": {}}')
+            compressor = Compressor(['gz'])
+            compressor.submit([path])
+            compressor.join()
+            with gzip.open(str(path) + '.gz') as f:
+                assert f.read() == b'{"products": {}}'
+
+    def test_unknown_format(self):
+        assert Compressor(['gz', 'foo']).extensions == ['.gz']
+
+    def test_stale_sidecar_removed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'images.json')
+            path.write_text('{}')
+            Compressor(['gz']).compress(path)
+            assert Path(tmpdir, 'images.json.gz').exists()
+
+            with Publication(['.gz']) as publication:
+                publication.stage(path, '{"products": {}}')
+            assert not Path(tmpdir, 'images.json.gz').exists()
+            assert publication.published == [path]
+
+    def test_not_committed_while_publishing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'images.json')
+            path.write_text('{}')
+            compressor = Compressor(['gz'])
+            with commit_lock:
+                thread = threading.Thread(target=compressor.compress,
+                                          args=(path,))
+                thread.start()
+                thread.join(0.2)
+                assert thread.is_alive()
+                # Published while the old content was being compressed
+                Path(tmpdir, 'new').write_text('{"products": {}}')
+                os.replace(str(Path(tmpdir, 'new')), str(path))
+            thread.join(5)
+
+            assert os.listdir(tmpdir) == ['images.json']
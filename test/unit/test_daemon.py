@@ -0,0 +1,187 @@
+import os
+import time
+import asyncio
+import tempfile
+from pathlib import Path
+from mock import Mock, patch
+from inotify.constants import IN_CLOSE_WRITE
+from lxd_image_server.cli import needs_update
+from lxd_image_server.tools.daemon import WatchDaemon
+from lxd_image_server.tools.mirror import Mirror, MirrorManager
+from lxd_image_server.tools.operation import (Operation, Operations,
+                                              OperationType)
+from lxd_image_server.tools.tree import ImageTree
+from lxd_image_server.tools.watcher import Watcher
+
+
+VERSION = 'iats/xenial/amd64/default/20180710_12:00'
+
+
+@patch('lxd_image_server.tools.daemon.reconcile_operations',
+       return_value=[])
+@patch('lxd_image_server.tools.daemon.MirrorManager.update_mirror_list')
+class TestWatchDaemon(object):
+
+    def _run(self, tmpdir, scenario, images=None, **kwargs):
+        tree = ImageTree(tmpdir)
+        tree.scan()
+        loop = asyncio.new_event_loop()
+        daemon = WatchDaemon(Watcher(tmpdir, IN_CLOSE_WRITE),
+                             images or Mock(), tree, needs_update,
+                             loop=loop, **kwargs)
+
+        async def main():
+            await asyncio.gather(daemon.serve(), scenario(daemon))
+        try:
+            loop.run_until_complete(asyncio.wait_for(main(), 10))
+        finally:
+            loop.close()
+        return daemon
+
+    def _mirror(self, tmpdir, command, name='mirror1'):
+        mirror = Mirror(name, 'lxdadm', '/etc/lxd-image-server/key',
+                        None, name + '.localhost', tmpdir, tmpdir)
+        mirror.rsync_command = Mock(return_value=command)
+        return mirror
+
+    def test_publish(self, update_mock, reconcile_mock):
+        images = Mock()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            async def scenario(daemon):
+                await asyncio.sleep(0.1)
+                path = Path(tmpdir, VERSION)
+                os.makedirs(str(path))
+                Path(path, 'lxd.tar.xz').touch()
+                Path(path, 'rootfs.squashfs').touch()
+                await asyncio.sleep(0.5)
+                daemon.stop()
+
+            self._run(tmpdir, scenario, images, quiet_period=0.1)
+
+        assert images.update.call_count == 1
+        ops = images.update.call_args[0][0]
+        assert [x.path for x in ops] == [str(Path(tmpdir, VERSION))]
+        assert images.save.call_count == 1
+        # The compressed copies are written before stopping
+        assert images.compressor.join.call_count == 1
+
+    def test_publish_pending_on_stop(self, update_mock, reconcile_mock):
+        images = Mock()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            async def scenario(daemon):
+                await asyncio.sleep(0.1)
+                os.makedirs(os.path.join(tmpdir, VERSION))
+                while not daemon.pending:
+                    await asyncio.sleep(0.01)
+                daemon.stop()
+
+            daemon = self._run(tmpdir, scenario, images, quiet_period=5,
+                               max_latency=5)
+
+        assert images.update.call_count == 1
+        assert daemon.pending == 0
+
+    def test_sync_mirrors(self, update_mock, reconcile_mock):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            synced = self._mirror(tmpdir, ['true'])
+            failed = self._mirror(tmpdir, ['false'], 'mirror2')
+
+            async def scenario(daemon):
+                await asyncio.sleep(0.1)
+                daemon.stop()
+
+            with patch.dict(MirrorManager.mirrors,
+                            {'mirror1': synced, 'mirror2': failed},
+                            clear=True):
+                self._run(tmpdir, scenario)
+
+        # A full sync is the images and the streams
+        assert synced.rsync_command.call_count == 2
+        assert synced.stats['syncs'] == 1
+        assert synced.stats['failures'] == 0
+        assert synced.lag == 0
+        assert failed.rsync_command.call_count == 1
+        assert failed.stats['failures'] == 1
+
+    def test_drain_timeout(self, update_mock, reconcile_mock):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mirror = self._mirror(tmpdir, ['sleep', '30'])
+
+            async def scenario(daemon):
+                await asyncio.sleep(0.1)
+                daemon.stop()
+
+            start = time.monotonic()
+            with patch.dict(MirrorManager.mirrors, {'mirror1': mirror},
+                            clear=True):
+                self._run(tmpdir, scenario, drain_timeout=0.2)
+
+        assert time.monotonic() - start < 5
+        assert mirror.rsync_command.call_count == 1
+        assert mirror.stats['failures'] == 1
+
+    def test_stop_during_reconcile(self, update_mock, reconcile_mock):
+        images = Mock()
+        images.update.side_effect = lambda ops: time.sleep(0.3)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            operations = Operations([], tmpdir)
+            for i in range(3):
+                operations.add(Operation(
+                    os.path.join(tmpdir, VERSION[:-1] + str(i)),
+                    OperationType.ADD_MOD, tmpdir))
+            reconcile_mock.return_value = operations
+
+            async def scenario(daemon):
+                while not images.update.called:
+                    await asyncio.sleep(0.01)
+                start = time.monotonic()
+                daemon.stop()
+                # The loop keeps running while the batch finishes
+                await asyncio.sleep(0.05)
+                assert time.monotonic() - start < 0.2
+
+            with patch('lxd_image_server.tools.daemon.RECONCILE_BATCH', 1):
+                self._run(tmpdir, scenario, images)
+
+        assert images.update.call_count == 1
+        assert images.save.call_count == 1
+
+    def test_sync_streams_snapshot(self, update_mock, reconcile_mock):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            img_dir = os.path.join(tmpdir, 'images')
+            streams_dir = Path(tmpdir, 'streams', 'v1')
+            os.makedirs(img_dir)
+            streams_dir.mkdir(parents=True)
+            Path(streams_dir, 'images.json').write_text('batch 1')
+            mirror = Mirror('mirror1', 'lxdadm', '/etc/lxd-image-server/key',
+                            None, 'mirror1.localhost', img_dir,
+                            str(streams_dir))
+            commands = []
+
+            def rsync_command(args):
+                commands.append(args)
+                if len(commands) == 1:
+                    # Published while the images are synced
+                    Path(streams_dir, '.images.json.tmp').write_text(
+                        'batch 2')
+                    os.replace(str(Path(streams_dir, '.images.json.tmp')),
+                               str(Path(streams_dir, 'images.json')))
+                    return ['true']
+                return ['grep', '-q', 'batch 1',
+                        os.path.join(args[0], 'images.json')]
+            mirror.rsync_command = Mock(side_effect=rsync_command)
+
+            async def scenario(daemon):
+                await asyncio.sleep(0.1)
+                daemon.stop()
+
+            with patch.dict(MirrorManager.mirrors, {'mirror1': mirror},
+                            clear=True), \
+                    patch.object(MirrorManager, 'streams_dir',
+                                 str(streams_dir)):
+                self._run(img_dir, scenario)
+
+            assert len(commands) == 2
+            assert mirror.stats['failures'] == 0
+            assert os.listdir(os.path.join(tmpdir, 'streams',
+                                           '.snapshots')) == []
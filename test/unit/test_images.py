@@ -1,12 +1,16 @@
 import json
+import hashlib
 import tempfile
 import os
 import copy
 import shutil
 from pathlib import Path
 from hamcrest import assert_that, is_, equal_to
+import mock
 from mock import patch
-from lxd_image_server.simplestreams.images import Images
+from lxd_image_server.simplestreams.images import Images, build_version
+from lxd_image_server.simplestreams.serializer import dumps
+from lxd_image_server.tools.checksum import ChecksumCache
 from lxd_image_server.tools.operation import OperationType, Operation
 
 
@@ -189,6 +193,31 @@ class TestImages(object):
             assert '20180620_12:18' not in images.root['products'][
                 'ubuntu:xenial:amd64:default']['versions']
 
+    @patch('lxd_image_server.simplestreams.images.Index')
+    def test_delete_root_prefix(self, mock_index):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            new_index = copy.deepcopy(INDEX)
+            product = new_index['products'].pop('ubuntu:xenial:amd64:default')
+            for name in ('ubuntu:1:amd64:default',
+                         'ubuntu:18.04:amd64:default',
+                         'ubuntu:1:i386:default'):
+                new_index['products'][name] = copy.deepcopy(product)
+            with open(str(Path(tmpdir, 'images.json')), 'w') as image_file:
+                json.dump(new_index, image_file)
+
+            images = Images(tmpdir)
+            images.update([
+                Operation(str(Path(tmpdir, 'ubuntu', '1')),
+                          OperationType.DELETE, tmpdir, True)
+            ])
+            assert list(images.root['products']) == [
+                'ubuntu:18.04:amd64:default']
+            mock_index.return_value.update.assert_called_once_with(
+                added=[], deleted=mock.ANY, content_id='images')
+            assert sorted(mock_index.return_value.update.call_args[1][
+                'deleted']) == ['ubuntu:1:amd64:default',
+                                'ubuntu:1:i386:default']
+
     @patch('lxd_image_server.simplestreams.images.Index')
     def test_move_root(self, mock_index):
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -213,3 +242,222 @@ class TestImages(object):
             ])
             assert 'ubuntu:xenial:amd64:default' not in images.root['products']
             assert 'ubuntu:xenial:amd64:other' in images.root['products']
+
+    @patch('lxd_image_server.simplestreams.images.Index')
+    def test_add_files_parallel(self, mock_index):
+        for executor in ('thread', 'process'):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                work_dir = self._generate_files('20180620_12:18', tmpdir)
+                extra_dir = self._generate_files('20180620_12:28', tmpdir)
+                new_index = copy.deepcopy(INDEX)
+                new_index['products']['ubuntu:xenial:amd64:default'][
+                    'versions'].update(EXTRA)
+
+                images = Images(tmpdir, rebuild=True, jobs=2,
+                                executor=executor)
+                images.update([
+                    Operation(work_dir, OperationType.ADD_MOD, tmpdir),
+                    Operation(extra_dir, OperationType.ADD_MOD, tmpdir)
+                ])
+
+                versions = images.root['products'][
+                    'ubuntu:xenial:amd64:default']['versions']
+                assert list(versions) == ['20180620_12:18', '20180620_12:28']
+                assert len(images.cache) == 6
+
+    def test_combined_checksum(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            work_dir = self._generate_files('20180620_12:18', tmpdir)
+            with open(os.path.join(work_dir, 'delta-20180620_12:00.vcdiff'),
+                      'w') as vcdiff:
+                vcdiff.write('CCCC')
+
+            cache = ChecksumCache()
+            version = build_version('20180620_12:18', work_dir, cache)
+            items = version.to_dict('images/ubuntu/xenial/amd64/default')[
+                'items']
+            combined = hashlib.sha256(
+                b'A' * 31 + b'B' * 32).hexdigest()
+            assert items['lxd.tar.xz']['combined_squashfs_sha256'] == \
+                combined
+            assert items['lxd.tar.xz']['sha256'] == INDEX['products'][
+                'ubuntu:xenial:amd64:default']['versions'][
+                '20180620_12:18']['items']['lxd.tar.xz']['sha256']
+            assert items['delta-20180620_12:00.vcdiff']['ftype'] == \
+                'squashfs.vcdiff'
+
+            cached = build_version('20180620_12:18', work_dir, cache)
+            assert cached == version
+
+    @patch('lxd_image_server.simplestreams.images.Index')
+    def test_save_only_changed_products(self, mock_index):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            extra_dir = self._generate_files('20180620_12:28', tmpdir)
+            new_index = copy.deepcopy(INDEX)
+            new_index['products']['ubuntu:bionic:amd64:default'] = \
+                copy.deepcopy(
+                    INDEX['products']['ubuntu:xenial:amd64:default'])
+            with open(str(Path(tmpdir, 'images.json')), 'w') as image_file:
+                json.dump(new_index, image_file)
+
+            images = Images(tmpdir)
+            images.save()
+            with open(str(Path(tmpdir, 'images.json'))) as image_file:
+                saved = json.load(image_file)
+            del saved['last_update']
+            assert_that(saved, is_(equal_to(new_index)))
+
+            with patch('lxd_image_server.simplestreams.images.dumps',
+                       wraps=dumps) as dumps_mock:
+                images.update([
+                    Operation(extra_dir, OperationType.ADD_MOD, tmpdir)
+                ])
+                images.save()
+                dumped = [x[0][0] for x in dumps_mock.call_args_list]
+            assert new_index['products']['ubuntu:bionic:amd64:default'] \
+                not in dumped
+            assert images.root['products']['ubuntu:xenial:amd64:default'] \
+                in dumped
+
+            with open(str(Path(tmpdir, 'images.json'))) as image_file:
+                saved = json.load(image_file)
+            assert_that(saved, is_(equal_to(images.root)))
+
+    @patch('lxd_image_server.simplestreams.images.Index')
+    def test_save_unchanged(self, mock_index):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            images = Images(tmpdir, rebuild=True)
+            images.save()
+            images_path = Path(tmpdir, 'images.json')
+            mtime = images_path.stat().st_mtime_ns
+            last_update = images.root['last_update']
+
+            images.save()
+            assert images.root['last_update'] == last_update
+            assert images_path.stat().st_mtime_ns == mtime
+            assert sorted(os.listdir(tmpdir)) == ['images.json',
+                                                  'manifest.json']
+
+    def test_rebuild_unchanged(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = self._generate_files('20180620_12:18', tmpdir)
+
+            def rebuild():
+                images = Images(tmpdir, rebuild=True)
+                images.update([Operation(path, OperationType.ADD_MOD,
+                                         tmpdir)])
+                images.save()
+                return images
+
+            images_path = Path(tmpdir, 'images.json')
+            last_update = rebuild().root['last_update']
+            mtime = images_path.stat().st_mtime_ns
+
+            assert rebuild().root['last_update'] == last_update
+            assert images_path.stat().st_mtime_ns == mtime
+
+            shutil.rmtree(path)
+            assert rebuild().root['last_update'] > last_update
+            assert images_path.stat().st_mtime_ns != mtime
+
+    def test_shards(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            work_dir = self._generate_files('20180620_12:18', tmpdir)
+            other_dir = os.path.join(tmpdir, 'debian', 'stretch', 'amd64',
+                                     'default', '20180620_12:18')
+            shutil.copytree(work_dir, other_dir)
+
+            images = Images(tmpdir, shard='os')
+            images.update([
+                Operation(work_dir, OperationType.ADD_MOD, tmpdir),
+                Operation(other_dir, OperationType.ADD_MOD, tmpdir)
+            ])
+            images.save()
+            assert sorted(os.listdir(tmpdir)) == [
+                'debian', 'images-debian.json', 'images-ubuntu.json',
+                'index.json', 'manifest.json', 'ubuntu']
+            with open(str(Path(tmpdir, 'index.json'))) as index_file:
+                index = json.load(index_file)['index']
+            assert sorted(index) == ['images:debian', 'images:ubuntu']
+            assert index['images:debian']['path'] == \
+                'streams/v1/images-debian.json'
+            assert index['images:debian']['products'] == [
+                'debian:stretch:amd64:default']
+            with open(str(Path(tmpdir, 'images-debian.json'))) as shard:
+                assert list(json.load(shard)['products']) == [
+                    'debian:stretch:amd64:default']
+
+            debian_mtime = Path(tmpdir, 'images-debian.json').stat() \
+                .st_mtime_ns
+            extra_dir = self._generate_files('20180620_12:28', tmpdir)
+            with patch('lxd_image_server.simplestreams.images.dumps',
+                       wraps=dumps) as dumps_mock:
+                images.update([
+                    Operation(extra_dir, OperationType.ADD_MOD, tmpdir)
+                ])
+                images.save()
+                dumped = [x[0][0] for x in dumps_mock.call_args_list]
+            assert 'images:debian' not in dumped
+            assert Path(tmpdir, 'images-debian.json').stat() \
+                .st_mtime_ns == debian_mtime
+
+            shutil.rmtree(other_dir)
+            images.update([
+                Operation(other_dir, OperationType.DELETE, tmpdir)
+            ])
+            images.save()
+            assert not Path(tmpdir, 'images-debian.json').exists()
+            with open(str(Path(tmpdir, 'index.json'))) as index_file:
+                assert list(json.load(index_file)['index']) == [
+                    'images:ubuntu']
+
+            # Back to a single file
+            images = Images(tmpdir)
+            images.save()
+            assert sorted(os.listdir(tmpdir)) == [
+                'debian', 'images.json', 'index.json', 'manifest.json',
+                'ubuntu']
+            with open(str(Path(tmpdir, 'images.json'))) as image_file:
+                saved = json.load(image_file)
+            assert saved['content_id'] == 'images'
+            assert list(saved['products']) == ['ubuntu:xenial:amd64:default']
+            assert len(saved['products']['ubuntu:xenial:amd64:default'][
+                'versions']) == 2
+
+    def test_manifest(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            work_dir = self._generate_files('20180620_12:18', tmpdir)
+            images = Images(tmpdir, rebuild=True)
+            images.update([
+                Operation(work_dir, OperationType.ADD_MOD, tmpdir)
+            ])
+            images.save()
+            manifest_path = Path(tmpdir, 'manifest.json')
+            with open(str(manifest_path)) as manifest_file:
+                manifest = json.load(manifest_file)
+            assert sorted(manifest['files']) == ['images.json', 'index.json']
+            for name, entry in manifest['files'].items():
+                content = Path(tmpdir, name).read_bytes()
+                assert entry == {
+                    'sha256': hashlib.sha256(content).hexdigest(),
+                    'size': len(content)
+                }
+
+            mtimes = {x: Path(tmpdir, x).stat().st_mtime_ns
+                      for x in ('images.json', 'index.json', 'manifest.json')}
+            images = Images(tmpdir)
+            images.save()
+            images.save()
+            assert mtimes == {
+                x: Path(tmpdir, x).stat().st_mtime_ns for x in mtimes}
+
+            extra_dir = self._generate_files('20180620_12:28', tmpdir)
+            images.update([
+                Operation(extra_dir, OperationType.ADD_MOD, tmpdir)
+            ])
+            images.save()
+            with open(str(manifest_path)) as manifest_file:
+                manifest = json.load(manifest_file)
+            assert manifest['files']['images.json']['sha256'] == \
+                hashlib.sha256(
+                    Path(tmpdir, 'images.json').read_bytes()).hexdigest()
@@ -1,4 +1,7 @@
 import json
+import tempfile
+from pathlib import Path
+from mock import patch
 from hamcrest import assert_that, is_, equal_to
 from lxd_image_server.simplestreams.index import Index
 
@@ -78,3 +81,33 @@ class TestIndex(object):
         index.delete('iats:xenial:amd64:default')
         out = json.loads(index.to_json())
         assert_that(out, is_(equal_to(INDEX)))
+
+    def test_sorted_bulk_update(self):
+        index = Index()
+        assert index.update(added=['product2', 'product3', 'product1'])
+        assert index.update(added=['product2'], deleted=['product3'])
+        assert not index.update(added=['product1'], deleted=['product4'])
+        out = json.loads(index.to_json())
+        assert out['index']['images']['products'] == ['product1',
+                                                      'product2']
+
+    def test_save_only_changed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_path = Path(tmpdir, 'index.json')
+            index = Index(tmpdir)
+            index.add('product1')
+            index.save()
+            mtime = index_path.stat().st_mtime_ns
+
+            index = Index(tmpdir)
+            assert not index.changed
+            index.add('product1')
+            with patch('lxd_image_server.simplestreams.index.Publication') \
+                    as publication:
+                index.save()
+            assert not publication.called
+            assert index_path.stat().st_mtime_ns == mtime
+
+            index.update(added=['product2'])
+            index.save()
+            assert Index(tmpdir).products == ['product1', 'product2']
@@ -0,0 +1,73 @@
+import os
+import tempfile
+from pathlib import Path
+from urllib.request import urlopen
+from urllib.error import HTTPError
+import pytest
+from lxd_image_server.tools.metrics import (Counter, Gauge, Histogram,
+                                            Registry, start_http_server,
+                                            write_textfile)
+
+
+class TestMetrics(object):
+
+    def test_render(self):
+        registry = Registry()
+        counter = Counter('syncs_total', 'Syncs', labels=['mirror'],
+                          registry=registry)
+        gauge = Gauge('depth', 'Depth', registry=registry)
+        histogram = Histogram('seconds', 'Time', buckets=(1, 5),
+                              registry=registry)
+        counter.inc(mirror='a')
+        counter.inc(2, mirror='a')
+        gauge.set_function(lambda: 3)
+        histogram.observe(0.5)
+        histogram.observe(2)
+
+        assert registry.render().splitlines() == [
+            '# HELP lxd_image_server_syncs_total Syncs',
+            '# TYPE lxd_image_server_syncs_total counter',
+            'lxd_image_server_syncs_total{mirror="a"} 3',
+            '# HELP lxd_image_server_depth Depth',
+            '# TYPE lxd_image_server_depth gauge',
+            'lxd_image_server_depth 3',
+            '# HELP lxd_image_server_seconds Time',
+            '# TYPE lxd_image_server_seconds histogram',
+            'lxd_image_server_seconds_bucket{le="1"} 1',
+            'lxd_image_server_seconds_bucket{le="5"} 2',
+            'lxd_image_server_seconds_bucket{le="+Inf"} 2',
+            'lxd_image_server_seconds_sum 2.5',
+            'lxd_image_server_seconds_count 2'
+        ]
+
+    def test_labels(self):
+        counter = Counter('total', 'Total', labels=['mirror'],
+                          registry=Registry())
+        with pytest.raises(ValueError):
+            counter.inc()
+        gauge = Gauge('lag', 'Lag', labels=['mirror'], registry=Registry())
+        gauge.set_function(lambda: {('a',): 1.5, ('b',): None})
+        assert gauge.render().splitlines()[-1] == \
+            'lxd_image_server_lag{mirror="a"} 1.5'
+
+    def test_http_server(self):
+        registry = Registry()
+        Counter('total', 'Total', registry=registry).inc()
+        server = start_http_server('127.0.0.1', 0, registry)
+        try:
+            url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+            body = urlopen(url + '/metrics').read().decode('utf-8')
+            assert 'lxd_image_server_total 1' in body
+            with pytest.raises(HTTPError):
+                urlopen(url + '/other')
+        finally:
+            server.shutdown()
+
+    def test_textfile(self):
+        registry = Registry()
+        Counter('total', 'Total', registry=registry).inc()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'lxd.prom')
+            write_textfile(path, registry)
+            assert 'lxd_image_server_total 1' in path.read_text()
+            assert os.listdir(tmpdir) == ['lxd.prom']
@@ -0,0 +1,240 @@
+import os
+import tempfile
+import subprocess
+import threading
+from pathlib import Path
+from mock import Mock, patch
+from lxd_image_server.tools import mirror as mirror_module
+from lxd_image_server.tools.mirror import (Mirror, MirrorManager,
+                                           StreamsSnapshot)
+from lxd_image_server.tools.operation import Operation, OperationType
+
+
+IMG_DIR = '/var/www/simplestreams/images'
+STREAMS_DIR = '/var/www/simplestreams/streams/v1'
+
+
+class TestMirror(object):
+
+    def _mirror(self):
+        return Mirror('mirror1', 'lxdadm', '/etc/lxd-image-server/key',
+                      None, 'mirror1.localhost', IMG_DIR, STREAMS_DIR)
+
+    @patch('lxd_image_server.tools.mirror.subprocess.run')
+    def test_sync_all(self, run_mock):
+        self._mirror().update()
+        commands = [x[0][0] for x in run_mock.call_args_list]
+        assert len(commands) == 2
+        assert commands[0][-3:] == [
+            IMG_DIR, 'mirror1.localhost:/var/www/simplestreams', '--delete']
+        assert commands[1][-3:] == [
+            STREAMS_DIR, 'mirror1.localhost:/var/www/simplestreams/streams',
+            '--delete']
+
+    @patch('lxd_image_server.tools.mirror.subprocess.run')
+    def test_sync_operations(self, run_mock):
+        self._mirror().update([
+            Operation(IMG_DIR + '/iats/xenial/amd64/default/20180710_12:00',
+                      OperationType.ADD_MOD, IMG_DIR),
+            Operation(IMG_DIR + '/iats/xenial/amd64/default/20180710_11:00',
+                      OperationType.DELETE, IMG_DIR),
+            Operation(IMG_DIR + '/iats/bionic', OperationType.DELETE,
+                      IMG_DIR, True)
+        ])
+        commands = [x[0][0] for x in run_mock.call_args_list]
+        assert len(commands) == 2
+        assert commands[0][4] == \
+            '--skip-compress=xz/gz/bz2/squashfs/vcdiff/qcow2/zst'
+        assert commands[0][5:] == [
+            '--include=/iats/',
+            '--include=/iats/xenial/',
+            '--include=/iats/xenial/amd64/',
+            '--include=/iats/xenial/amd64/default/',
+            '--include=/iats/xenial/amd64/default/20180710_12:00/***',
+            '--include=/iats/xenial/amd64/default/20180710_11:00/***',
+            '--include=/iats/bionic/***',
+            '--exclude=*',
+            IMG_DIR + '/', 'mirror1.localhost:' + IMG_DIR + '/',
+            '--delete'
+        ]
+        assert commands[1][-3] == STREAMS_DIR
+
+    @patch('lxd_image_server.tools.mirror.subprocess.run')
+    def test_transfer_options(self, run_mock):
+        mirror = Mirror('mirror1', 'lxdadm', '/etc/lxd-image-server/key',
+                        None, 'mirror1.localhost', IMG_DIR,
+                        compress=False, bwlimit='50M', partial=True,
+                        timeout=600, control_persist='10m')
+        mirror.update()
+        command = run_mock.call_args[0][0]
+        assert command[:3] == ['rsync', '-ah', '-e']
+        assert command[3] == (
+            '/usr/bin/ssh -i /etc/lxd-image-server/key -l lxdadm '
+            '-o ControlMaster=auto '
+            '-o ControlPath=/var/run/lxd-image-server/ssh-%C '
+            '-o ControlPersist=10m -o ConnectTimeout=600')
+        assert command[4:7] == ['--bwlimit=50M',
+                                '--partial-dir=.rsync-partial',
+                                '--timeout=600']
+
+    @patch('lxd_image_server.tools.mirror.subprocess.run')
+    def test_partial_dir_protected(self, run_mock):
+        mirror = Mirror('mirror1', 'lxdadm', '/etc/lxd-image-server/key',
+                        None, 'mirror1.localhost', IMG_DIR, partial=True)
+        mirror.update([
+            Operation(IMG_DIR + '/iats/xenial/amd64/default/20180710_12:00',
+                      OperationType.ADD_MOD, IMG_DIR)])
+        command = run_mock.call_args[0][0]
+        # Before the includes that match the partial directories
+        assert command.index('--filter=P .rsync-partial/') < \
+            command.index('--include=/iats/')
+        assert command.index('--partial-dir=.rsync-partial') < \
+            command.index('--filter=P .rsync-partial/')
+
+    @patch('lxd_image_server.tools.mirror.subprocess.run')
+    def test_metadata_not_synced_on_failure(self, run_mock):
+        run_mock.return_value.check_returncode.side_effect = \
+            subprocess.CalledProcessError(1, 'rsync')
+        self._mirror().update([
+            Operation(IMG_DIR + '/iats/xenial/amd64/default/20180710_12:00',
+                      OperationType.ADD_MOD, IMG_DIR)
+        ])
+        assert run_mock.call_count == 1
+
+    def test_pending_syncs_merged(self):
+        mirror = self._mirror()
+        started = threading.Event()
+        release = threading.Event()
+        synced = []
+
+        def update(operations=None):
+            synced.append(operations)
+            started.set()
+            release.wait(5)
+            return True
+
+        def op(version, operation=OperationType.ADD_MOD):
+            return Operation(IMG_DIR + '/iats/xenial/amd64/default/' +
+                             version, operation, IMG_DIR)
+
+        with patch.object(mirror, 'update', side_effect=update):
+            mirror.submit([op('20180710_11:00')])
+            started.wait(5)
+            mirror.submit([op('20180710_12:00')])
+            mirror.submit([op('20180710_13:00'),
+                           op('20180710_12:00', OperationType.DELETE)])
+            assert mirror.lag > 0
+            mirror.stop()
+            release.set()
+            mirror._thread.join(5)
+
+        assert [[str(x) for x in ops] for ops in synced] == [
+            [str(op('20180710_11:00'))]
+        ]
+        assert [str(x) for x in mirror._pending] == [
+            str(op('20180710_13:00')),
+            str(op('20180710_12:00', OperationType.DELETE))
+        ]
+        assert mirror.stats['syncs'] == 1
+        assert mirror.stats['failures'] == 0
+
+    @patch('lxd_image_server.tools.mirror.subprocess.run')
+    def test_failed_sync_retried(self, run_mock):
+        def op(version):
+            return Operation(IMG_DIR + '/iats/xenial/amd64/default/' +
+                             version, OperationType.ADD_MOD, IMG_DIR)
+
+        mirror = self._mirror()
+        run_mock.return_value.check_returncode.side_effect = \
+            subprocess.CalledProcessError(1, 'rsync')
+        mirror.queue([op('20180710_11:00')])
+        _, operations = mirror.take()
+        mirror.record(0, mirror.update(operations), operations)
+        assert mirror.stats['failures'] == 1
+
+        run_mock.reset_mock()
+        run_mock.return_value.check_returncode.side_effect = None
+        mirror.queue([op('20180710_12:00')])
+        _, operations = mirror.take()
+        mirror.record(0, mirror.update(operations), operations)
+
+        commands = [x[0][0] for x in run_mock.call_args_list]
+        assert len(commands) == 2
+        assert '--include=/iats/xenial/amd64/default/20180710_11:00/***' \
+            in commands[0]
+        assert '--include=/iats/xenial/amd64/default/20180710_12:00/***' \
+            in commands[0]
+        assert commands[1][-3] == STREAMS_DIR
+        assert mirror.lag == 0
+
+    def test_failed_full_sync_retried(self):
+        mirror = self._mirror()
+        mirror.queue()
+        _, operations = mirror.take()
+        mirror.record(0, False, operations)
+        mirror.queue([Operation(IMG_DIR + '/iats/xenial', OperationType.DELETE,
+                                IMG_DIR, True)])
+        assert mirror.take() == (True, None)
+
+    @patch.object(mirror_module, 'MAX_SYNC_VERSIONS', 2)
+    def test_large_sync_is_full(self):
+        operations = [
+            Operation(IMG_DIR + '/iats/xenial/amd64/default/' + version,
+                      OperationType.ADD_MOD, IMG_DIR)
+            for version in ['20180710_11:00', '20180710_12:00',
+                            '20180710_13:00']]
+        commands = self._mirror().commands(operations)
+        assert commands == [
+            [IMG_DIR, 'mirror1.localhost:/var/www/simplestreams'],
+            [STREAMS_DIR, 'mirror1.localhost:/var/www/simplestreams/streams']
+        ]
+        assert len(self._mirror().commands(operations[:2])[0]) > 2
+
+    def test_semaphore_of_reloaded_configuration(self):
+        mirror = self._mirror()
+        synced = threading.Event()
+        semaphores = [Mock(), Mock()]
+
+        with patch.object(mirror, 'update', side_effect=lambda ops: True), \
+                patch.object(mirror, 'record',
+                             side_effect=lambda *args: synced.set()):
+            for semaphore in semaphores:
+                synced.clear()
+                with patch.object(MirrorManager, '_semaphore', semaphore):
+                    mirror.submit()
+                    synced.wait(5)
+            mirror.stop()
+            mirror._thread.join(5)
+
+        for semaphore in semaphores:
+            assert semaphore.acquire.call_count == 1
+            assert semaphore.release.call_count == 1
+
+    def test_streams_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            streams_dir = Path(tmpdir, 'streams', 'v1')
+            streams_dir.mkdir(parents=True)
+            Path(streams_dir, 'images.json').write_text('batch 1')
+            Path(streams_dir, '.images.json.tmp').write_text('batch 2')
+            mirror = Mirror('mirror1', 'lxdadm', '/etc/lxd-image-server/key',
+                            None, 'mirror1.localhost', IMG_DIR,
+                            str(streams_dir))
+
+            snapshot = StreamsSnapshot(str(streams_dir))
+            mirror.queue(None, snapshot)
+            snapshot.release()
+            # Published after the sync was queued
+            os.replace(str(Path(streams_dir, '.images.json.tmp')),
+                       str(Path(streams_dir, 'images.json')))
+
+            mirror.take()
+            source, destination = mirror.commands()[-1]
+            assert Path(source).name == 'v1'
+            assert os.listdir(source) == ['images.json']
+            assert Path(source, 'images.json').read_text() == 'batch 1'
+            assert destination == 'mirror1.localhost:' + \
+                str(Path(tmpdir, 'streams'))
+
+            mirror.record(0, True)
+            assert not Path(source).exists()
+            assert os.listdir(str(Path(tmpdir, 'streams', '.snapshots'))) == []
@@ -0,0 +1,82 @@
+import copy
+from hamcrest import assert_that, is_, equal_to
+from lxd_image_server.simplestreams.model import Product, Products
+
+
+PRODUCT = {
+    'versions': {
+        '20180620_12:18': {
+            'items': {
+                'lxd.tar.xz': {
+                    'sha256': '55ee740f58335c97d42c32125218eb7c325f'
+                              'be34206912f1aa7af7fd6580c9a1',
+                    'size': 31,
+                    'path': 'images/ubuntu/xenial/amd64/default/'
+                            '20180620_12:18/lxd.tar.xz',
+                    'ftype': 'lxd.tar.xz',
+                    'combined_squashfs_sha256':
+                        'f3cb81db18dfc60c9ce1ffc07b5614549dc22'
+                        '22890254ba4ccf2469f58e57a5d'
+                },
+                'rootfs.squashfs': {
+                    'sha256': 'not-a-digest',
+                    'size': 32,
+                    'path': 'elsewhere/rootfs.squashfs',
+                    'ftype': 'squashfs',
+                    'extra': True
+                }
+            }
+        }
+    },
+    'os': 'ubuntu',
+    'release': 'xenial',
+    'release_title': 'xenial',
+    'arch': 'amd64',
+    'aliases': 'ubuntu/xenial/amd64/default'
+}
+
+
+class TestModel(object):
+
+    def test_round_trip(self):
+        product = Product.from_dict('ubuntu:xenial:amd64:default',
+                                    copy.deepcopy(PRODUCT))
+        assert_that(product.to_dict(), is_(equal_to(PRODUCT)))
+
+    def test_compact_fields(self):
+        product = Product.from_dict('ubuntu:xenial:amd64:default', PRODUCT)
+        items = product.versions['20180620_12:18'].items
+        assert len(items['lxd.tar.xz'].sha256) == 32
+        assert len(items['lxd.tar.xz'].combined) == 32
+        assert items['lxd.tar.xz'].path is None
+        assert items['rootfs.squashfs'].path == 'elsewhere/rootfs.squashfs'
+        assert items['rootfs.squashfs'].extra == {'extra': True}
+        assert not hasattr(items['lxd.tar.xz'], '__dict__')
+
+    def test_from_name(self):
+        product = Product.from_name('ubuntu:xenial:amd64:default')
+        assert product.to_dict() == {
+            'versions': {},
+            'os': 'ubuntu',
+            'release': 'xenial',
+            'release_title': 'xenial',
+            'arch': 'amd64',
+            'aliases': 'ubuntu/xenial/amd64/default'
+        }
+        assert product.path == 'images/ubuntu/xenial/amd64/default'
+
+    def test_products_under(self):
+        products = Products()
+        for name in ('ubuntu:1:amd64:default', 'ubuntu:18.04:amd64:default',
+                     'ubuntu:1:i386:default', 'debian:9:amd64:default'):
+            products[name] = Product.from_name(name)
+        assert products.under('ubuntu:1') == ['ubuntu:1:amd64:default',
+                                              'ubuntu:1:i386:default']
+        assert products.under('ubuntu:1:i386:default') == [
+            'ubuntu:1:i386:default']
+        assert len(products.under('')) == 4
+
+        del products['ubuntu:1:amd64:default']
+        assert products.under('ubuntu:1:amd64') == []
+        assert products.under('ubuntu') == ['ubuntu:18.04:amd64:default',
+                                            'ubuntu:1:i386:default']
@@ -0,0 +1,27 @@
+import pytest
+from lxd_image_server.tools.paths import PathInfo, is_version, resolve_path
+
+
+class TestPaths(object):
+
+    def test_is_version(self):
+        assert is_version('20180710_12:00')
+        assert not is_version('default')
+        assert not is_version('rootfs.squashfs')
+
+    def test_resolve_version(self):
+        assert resolve_path(
+            '/var/www/images/',
+            '/var/www/images/iats/xenial/amd64/default/20180710_12:00') == \
+            PathInfo('iats:xenial:amd64:default', '20180710_12:00', True)
+
+    def test_resolve_product(self):
+        assert resolve_path(
+            '/var/www/images', '/var/www/images/iats/xenial') == \
+            PathInfo('iats:xenial', None, False)
+        assert resolve_path('/var/www/images', '/var/www/images') == \
+            PathInfo('', None, False)
+
+    def test_resolve_outside_root(self):
+        with pytest.raises(ValueError):
+            resolve_path('/var/www/images', '/var/www/other')
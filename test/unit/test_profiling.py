@@ -0,0 +1,49 @@
+import json
+import os
+import tempfile
+from mock import patch
+from lxd_image_server.tools.profiling import Profiler, batch, span
+
+
+class TestProfiling(object):
+
+    @patch('lxd_image_server.tools.profiling.logger')
+    def test_batch_record(self, logger_mock):
+        with span('outside'):
+            pass
+        with batch('watch') as timings:
+            with span('hash'):
+                pass
+            with span('hash'):
+                pass
+            with span('save'):
+                pass
+            timings.fields['operations'] = 3
+
+        assert logger_mock.info.call_count == 1
+        record = json.loads(logger_mock.info.call_args[0][0])
+        assert record['batch'] == 'watch'
+        assert record['operations'] == 3
+        assert sorted(record['spans']) == ['hash', 'save']
+        assert record['total'] >= record['spans']['hash']
+
+    @patch('lxd_image_server.tools.profiling.logger')
+    def test_discard(self, logger_mock):
+        with batch('watch') as timings:
+            timings.discard()
+        assert not logger_mock.info.called
+
+    def test_profiler_toggle(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            profiler = Profiler()
+            with profiler.profile():
+                pass
+            assert profiler.toggle(tmpdir) is None
+            assert profiler.active
+            with profiler.profile():
+                sorted(str(x) for x in range(1000))
+            prefix = profiler.toggle(tmpdir)
+            assert not profiler.active
+            assert sorted(os.listdir(tmpdir)) == [
+                os.path.basename(prefix) + x
+                for x in ('.pstats', '.tracemalloc', '.tracemalloc.txt')]
@@ -0,0 +1,65 @@
+import os
+import hashlib
+import tempfile
+from pathlib import Path
+import pytest
+from lxd_image_server.tools.publish import Publication
+
+
+class TestPublication(object):
+
+    def test_publish_in_order(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with Publication() as publication:
+                assert publication.stage(Path(tmpdir, 'images.json'), '{}')
+                assert publication.stage(Path(tmpdir, 'index.json'),
+                                         ['{', '}'])
+                assert sorted(os.listdir(tmpdir)) == [
+                    '.images.json.tmp', '.index.json.tmp']
+                assert [x[1].name for x in publication.staged] == [
+                    'images.json', 'index.json']
+                assert publication.digests[Path(tmpdir, 'index.json')] == \
+                    (hashlib.sha256(b'{}').hexdigest(), 2)
+            assert sorted(os.listdir(tmpdir)) == [
+                'images.json', 'index.json']
+            assert Path(tmpdir, 'index.json').read_text() == '{}'
+
+    def test_unchanged(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'index.json')
+            path.write_text('{}')
+            with Publication() as publication:
+                assert not publication.stage(path, '{}')
+            assert os.listdir(tmpdir) == ['index.json']
+
+    def test_abort(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'index.json')
+            path.write_text('{}')
+            with pytest.raises(ValueError):
+                with Publication() as publication:
+                    publication.stage(path, '{"a": 1}')
+                    raise ValueError()
+            assert os.listdir(tmpdir) == ['index.json']
+            assert path.read_text() == '{}'
+
+    def test_remove(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ('images-old.json', 'images-old.json.gz'):
+                Path(tmpdir, name).write_text('{}')
+            with Publication(['.gz']) as publication:
+                publication.stage(Path(tmpdir, 'index.json'), '{}')
+                publication.remove(Path(tmpdir, 'images-old.json'))
+                assert Path(tmpdir, 'images-old.json').exists()
+            assert os.listdir(tmpdir) == ['index.json']
+
+    def test_unlink_every_sidecar(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ('images.json', 'images.json.gz', 'images.json.br',
+                         'images-old.json', 'images-old.json.zst'):
+                Path(tmpdir, name).write_text('{}')
+            # Whatever formats the compressor is configured with now
+            with Publication() as publication:
+                publication.stage(Path(tmpdir, 'images.json'), '{"a": 1}')
+                publication.remove(Path(tmpdir, 'images-old.json'))
+            assert os.listdir(tmpdir) == ['images.json']
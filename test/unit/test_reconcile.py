@@ -0,0 +1,111 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+from mock import patch
+from lxd_image_server.simplestreams.images import Images
+from lxd_image_server.tools.checksum import stat_signature
+from lxd_image_server.tools.operation import Operation, OperationType
+from lxd_image_server.tools.reconcile import reconcile_operations
+from lxd_image_server.tools.tree import ImageTree
+
+
+class TestReconcile(object):
+
+    def _generate_files(self, version, tmpdir):
+        work_dir = os.path.join(tmpdir, 'ubuntu', 'xenial',
+                                'amd64', 'default', version)
+        os.makedirs(work_dir)
+        Path(work_dir, 'lxd.tar.xz').write_text('A' * 31)
+        Path(work_dir, 'rootfs.squashfs').write_text('B' * 32)
+        return work_dir
+
+    def _reconcile(self, images, tmpdir):
+        tree = ImageTree(tmpdir)
+        tree.scan()
+        return reconcile_operations(images, tree).ops
+
+    @patch('lxd_image_server.simplestreams.images.Index')
+    def test_reconcile(self, mock_index):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            changed = self._generate_files('20180620_12:18', tmpdir)
+            deleted = self._generate_files('20180620_12:28', tmpdir)
+            unchanged = self._generate_files('20180620_12:38', tmpdir)
+            images = Images(tmpdir, rebuild=True)
+            images.update([
+                Operation(x, OperationType.ADD_MOD, tmpdir)
+                for x in (changed, deleted, unchanged)])
+            assert self._reconcile(images, tmpdir) == []
+
+            Path(changed, 'rootfs.squashfs').write_text('C' * 32)
+            shutil.rmtree(deleted)
+            added = self._generate_files('20180620_12:48', tmpdir)
+
+            assert self._reconcile(images, tmpdir) == [
+                Operation(changed, OperationType.ADD_MOD, tmpdir),
+                Operation(added, OperationType.ADD_MOD, tmpdir),
+                Operation(deleted, OperationType.DELETE, tmpdir)
+            ]
+
+    @patch('lxd_image_server.simplestreams.images.Index')
+    def test_unknown_checksum(self, mock_index):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = self._generate_files('20180620_12:18', tmpdir)
+            images = Images(tmpdir, rebuild=True)
+            images.update([Operation(path, OperationType.ADD_MOD, tmpdir)])
+
+            images.cache = Images(tmpdir, rebuild=True).cache
+            assert self._reconcile(images, tmpdir) == [
+                Operation(path, OperationType.ADD_MOD, tmpdir)]
+
+    def test_without_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            img_dir = os.path.join(tmpdir, 'images')
+            streams_dir = os.path.join(tmpdir, 'streams')
+            os.makedirs(streams_dir)
+            unchanged = self._generate_files('20180620_12:18', img_dir)
+            changed = self._generate_files('20180620_12:28', img_dir)
+            images = Images(streams_dir, rebuild=True)
+            images.update([Operation(x, OperationType.ADD_MOD, img_dir)
+                           for x in (unchanged, changed)])
+            images.save()
+            # Modified after the catalogue was published, same size
+            os.utime(os.path.join(changed, 'lxd.tar.xz'),
+                     (time.time() + 60, time.time() + 60))
+
+            images = Images(streams_dir)
+            assert len(images.cache) == 0
+            assert self._reconcile(images, img_dir) == [
+                Operation(changed, OperationType.ADD_MOD, img_dir)]
+            # The checksums of the unchanged files are the published ones
+            filename = os.path.join(unchanged, 'rootfs.squashfs')
+            assert images.cache.lookup(
+                filename, stat_signature(filename), unverified=True
+            ) == hashlib.sha256(b'B' * 32).hexdigest()
+            # but they are not trusted to publish the files
+            assert images.cache.lookup(filename,
+                                       stat_signature(filename)) is None
+
+    def test_stale_cache_entry(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            img_dir = os.path.join(tmpdir, 'images')
+            streams_dir = os.path.join(tmpdir, 'streams')
+            os.makedirs(streams_dir)
+            path = self._generate_files('20180620_12:18', img_dir)
+            images = Images(streams_dir, rebuild=True)
+            images.update([Operation(path, OperationType.ADD_MOD, img_dir)])
+            images.save()
+
+            # Replaced by a file of the same size with an older mtime
+            filename = os.path.join(path, 'lxd.tar.xz')
+            os.unlink(filename)
+            Path(filename).write_text('D' * 31)
+            os.utime(filename, (time.time() - 3600, time.time() - 3600))
+
+            cache = images.cache
+            images = Images(streams_dir)
+            images.cache = cache
+            assert self._reconcile(images, img_dir) == [
+                Operation(path, OperationType.ADD_MOD, img_dir)]
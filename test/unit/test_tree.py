@@ -0,0 +1,60 @@
+import os
+import tempfile
+from pathlib import Path
+from mock import patch
+from lxd_image_server.tools.tree import ImageTree
+from lxd_image_server.tools.operation import (Operations, Operation,
+                                              OperationType)
+
+
+class TestImageTree(object):
+
+    def _generate(self, tmpdir, *versions):
+        for version in versions:
+            path = Path(tmpdir, 'iats/xenial/amd64/default', version)
+            os.makedirs(str(path))
+            Path(path, 'lxd.tar.xz').touch()
+            Path(path, 'rootfs.squashfs').touch()
+        return str(Path(tmpdir, 'iats/xenial/amd64/default'))
+
+    def test_scan(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = self._generate(tmpdir, '20180710_13:00', '20180710_12:00')
+            tree = ImageTree(tmpdir)
+            tree.scan()
+            assert tree.versions_under(tmpdir) == [
+                path + '/20180710_12:00', path + '/20180710_13:00']
+            assert tree.files(path + '/20180710_12:00') == {
+                'lxd.tar.xz', 'rootfs.squashfs'}
+
+    def test_apply_events(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = self._generate(tmpdir, '20180710_12:00')
+            tree = ImageTree(tmpdir)
+            tree.scan()
+            version = path + '/20180710_12:00'
+            with patch('lxd_image_server.tools.tree.os.scandir') as scandir:
+                tree.apply((None, ['IN_DELETE'], version, 'lxd.tar.xz'))
+                assert tree.files(version) == {'rootfs.squashfs'}
+                tree.apply((None, ['IN_ISDIR', 'IN_MOVED_FROM'],
+                            str(Path(path).parent), 'default'))
+                assert tree.versions_under(tmpdir) == []
+                assert not scandir.called
+
+    def test_operations_from_tree(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = self._generate(tmpdir, '20180710_12:00')
+            tree = ImageTree(tmpdir)
+            tree.scan()
+            version = path + '/20180710_12:00'
+            os.remove(version + '/lxd.tar.xz')
+            os.remove(version + '/rootfs.squashfs')
+            events = [
+                (None, ['IN_DELETE'], version, 'lxd.tar.xz'),
+                (None, ['IN_DELETE'], version, 'rootfs.squashfs')
+            ]
+            with patch('lxd_image_server.tools.tree.os.scandir') as scandir:
+                operations = Operations(events, tmpdir, tree)
+                assert not scandir.called
+            assert operations.ops == [
+                Operation(version, OperationType.DELETE, tmpdir)]
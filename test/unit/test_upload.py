@@ -0,0 +1,114 @@
+import io
+import os
+import json
+import hashlib
+import tempfile
+from http.client import HTTPConnection
+from pathlib import Path
+import pytest
+from mock import patch
+from lxd_image_server.simplestreams.images import build_version
+from lxd_image_server.tools.checksum import ChecksumCache
+from lxd_image_server.tools.upload import (UploadError, Uploads,
+                                           start_upload_server)
+
+
+VERSION = 'iats/xenial/amd64/default/20180710_12:00'
+LXD = b'lxd metadata' * 1000
+ROOTFS = b'rootfs' * 300000
+
+
+class TestUploads(object):
+
+    def _uploads(self, tmpdir):
+        img_dir = Path(tmpdir, 'images')
+        img_dir.mkdir()
+        return Uploads(str(img_dir), ChecksumCache())
+
+    def _receive(self, uploads, name, content, sha256=None):
+        return uploads.receive(VERSION + '/' + name, io.BytesIO(content),
+                               len(content), sha256)
+
+    def test_receive(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            uploads = self._uploads(tmpdir)
+            assert self._receive(uploads, 'lxd.tar.xz', LXD) == \
+                hashlib.sha256(LXD).hexdigest()
+            self._receive(uploads, 'rootfs.squashfs', ROOTFS)
+
+            path = Path(uploads.img_dir, VERSION)
+            assert Path(path, 'rootfs.squashfs').read_bytes() == ROOTFS
+            assert os.listdir(uploads.staging_dir) == []
+
+            # Published from the checksums of the upload only
+            with patch('lxd_image_server.simplestreams.images.sha256_files',
+                       side_effect=AssertionError), \
+                    patch('lxd_image_server.tools.checksum.sha256_file',
+                          side_effect=AssertionError):
+                version = build_version('20180710_12:00', str(path),
+                                        uploads.cache)
+
+        assert version.items['lxd.tar.xz'].sha256 == \
+            hashlib.sha256(LXD).digest()
+        assert version.items['rootfs.squashfs'].sha256 == \
+            hashlib.sha256(ROOTFS).digest()
+        assert version.items['lxd.tar.xz'].combined == \
+            hashlib.sha256(LXD + ROOTFS).digest()
+
+    def test_squashfs_first(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            uploads = self._uploads(tmpdir)
+            self._receive(uploads, 'rootfs.squashfs', ROOTFS)
+            self._receive(uploads, 'lxd.tar.xz', LXD)
+            path = Path(uploads.img_dir, VERSION)
+            version = build_version('20180710_12:00', str(path),
+                                    uploads.cache)
+
+        assert version.items['lxd.tar.xz'].combined == \
+            hashlib.sha256(LXD + ROOTFS).digest()
+
+    def test_invalid(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            uploads = self._uploads(tmpdir)
+            for path in ['iats/lxd.tar.xz',
+                         'iats/20180710_12:00/lxd.tar.xz',
+                         'iats/xenial/amd64/20180710_12:00/lxd.tar.xz',
+                         'iats/xenial/amd64/default/lxd.tar.xz',
+                         VERSION + '/lxd.tar.xz/rootfs.squashfs',
+                         'iats/../../20180710_12:00/lxd.tar.xz',
+                         VERSION + '/.lxd.tar.xz']:
+                with pytest.raises(UploadError):
+                    uploads.receive(path, io.BytesIO(LXD), len(LXD))
+
+            with pytest.raises(UploadError):
+                self._receive(uploads, 'lxd.tar.xz', LXD, '00' * 32)
+            with pytest.raises(UploadError):
+                uploads.receive(VERSION + '/lxd.tar.xz', io.BytesIO(LXD),
+                                len(LXD) + 1)
+            assert not Path(uploads.img_dir, VERSION).exists()
+            assert os.listdir(uploads.staging_dir) == []
+            assert len(uploads.cache) == 0
+
+    def test_server(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            uploads = self._uploads(tmpdir)
+            server = start_upload_server('127.0.0.1:0', uploads)
+            try:
+                connection = HTTPConnection(*server.server_address)
+                connection.request(
+                    'PUT', '/images/' + VERSION.replace(':', '%3A') +
+                    '/lxd.tar.xz', LXD)
+                response = connection.getresponse()
+                assert response.status == 201
+                assert json.loads(response.read().decode('utf-8')) == \
+                    {'sha256': hashlib.sha256(LXD).hexdigest()}
+
+                connection = HTTPConnection(*server.server_address)
+                connection.request('PUT', '/images/iats/lxd.tar.xz', LXD)
+                assert connection.getresponse().status == 400
+            finally:
+                server.shutdown()
+                server.server_close()
+
+            assert Path(uploads.img_dir, VERSION, 'lxd.tar.xz').read_bytes() \
+                == LXD
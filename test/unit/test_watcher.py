@@ -0,0 +1,66 @@
+import os
+import tempfile
+from pathlib import Path
+from inotify.constants import IN_CLOSE_WRITE
+from lxd_image_server.tools.watcher import Watcher
+
+
+class TestWatcher(object):
+
+    def test_crawl(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'iats/xenial/amd64/default'))
+            watcher = Watcher(tmpdir, IN_CLOSE_WRITE, crawl_step=2)
+            watcher._crawl()
+            assert watcher.watch_count == 2
+            assert watcher.crawl_time is None
+            watcher._crawl()
+            watcher._crawl()
+            assert watcher.watch_count == 5
+            assert watcher.crawl_time is not None
+
+    def test_new_subtree(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            watcher = Watcher(tmpdir, IN_CLOSE_WRITE)
+            watcher._crawl()
+            path = os.path.join(tmpdir, 'iats/xenial/amd64/default',
+                                '20180710_12:00')
+            os.makedirs(path)
+            Path(path, 'lxd.tar.xz').touch()
+
+            events = next(watcher.batches(timeout_s=0.1))
+            events = [(x[1], x[2], x[3]) for x in events]
+            assert (['IN_CREATE', 'IN_ISDIR'], tmpdir, 'iats') in events
+            assert (['IN_ISDIR', 'IN_CREATE'], str(Path(path).parent),
+                    '20180710_12:00') in events
+            assert (['IN_CLOSE_WRITE'], path, 'lxd.tar.xz') in events
+            assert watcher.watch_count == 6
+
+    def test_polling(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'iats/xenial/amd64/default')
+            os.makedirs(os.path.join(path, '20180710_12:00'))
+            watcher = Watcher(tmpdir, IN_CLOSE_WRITE, poll_interval=0)
+            watcher._start_polling()
+            assert watcher.polling
+            os.rmdir(os.path.join(path, '20180710_12:00'))
+            os.makedirs(os.path.join(path, '20180710_13:00'))
+
+            assert watcher._poll() == [
+                (None, ['IN_ISDIR', 'IN_MOVED_TO'], path, '20180710_13:00'),
+                (None, ['IN_ISDIR', 'IN_MOVED_FROM'], path, '20180710_12:00')
+            ]
+            assert watcher._poll() == []
+
+    def test_no_crawl_while_polling(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            watcher = Watcher(tmpdir, IN_CLOSE_WRITE, poll_interval=60)
+            watcher._crawl()
+            watcher._start_polling()
+            os.makedirs(os.path.join(tmpdir, 'iats/xenial'))
+
+            events = watcher.read()
+            assert [(x[1], x[3]) for x in events] == \
+                [(['IN_CREATE', 'IN_ISDIR'], 'iats')]
+            assert not watcher.crawling
+            assert not watcher._crawl_queue